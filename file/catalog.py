@@ -0,0 +1,187 @@
+'''
+catalog
+
+catalog of all s3d archives in the EQ directory for zonewalk
+(c) gsk 2012
+
+
+Copyright (c) 2012, Gedolian Soft Kram
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided
+that the following conditions are met:
+
+    Redistributions of source code must retain the above copyright notice, this list of conditions
+    and the following disclaimer.
+    Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+    and the following disclaimer in the documentation and/or other materials provided with the distribution.
+    Neither the name of the <ORGANIZATION> nor the names of its contributors may be used to endorse or
+    promote products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+The catalog lists every .s3d archive under the EQ base directory together with the files
+it holds (name, inflated size, directory crc and data offset) and groups the archives by zone.
+It is stored as a json file and only the archives whose size or modification time have changed
+get rescanned when it is updated, so answering "does zone xyz exist" or "which archive holds
+texture abc.bmp" does not require opening any archives.
+
+A zone is an archive shortname.s3d holding shortname.wld, its group are the archives
+shortname_obj.s3d, shortname_2_obj.s3d and shortname_chr.s3d (whichever exist).
+
+'''
+
+import os
+import json
+
+from s3dfile import S3DFile
+
+CATALOG_VERSION = 1
+
+# archive name suffixes that belong to a zone, in load order
+ZONE_ARCHIVE_SUFFIXES = ['', '_obj', '_2_obj', '_chr']
+
+
+class S3DCatalog():
+
+    def __init__(self, basepath, filename):
+        self.basepath = basepath
+        self.filename = filename
+
+        self.archives = {}      # lower case archive name (no extension) -> archive record, see scanArchive()
+        self.zones = {}         # zone short name -> list of archive names making up the zone
+        self.files = {}         # lower case file name -> list of archive names holding it
+
+    def load(self):
+        try:
+            cfile = open(self.filename, 'r')
+            catalog = json.load(cfile)
+            cfile.close()
+        except (IOError, ValueError):
+            return -1
+
+        if catalog.get('version') != CATALOG_VERSION or catalog.get('basepath') != self.basepath:
+            return -1
+
+        self.archives = catalog['archives']
+        self.zones = catalog['zones']
+        self.buildFileIndex()
+        return 0
+
+    def save(self):
+        catalog = { 'version' : CATALOG_VERSION, 'basepath' : self.basepath,
+                    'archives' : self.archives, 'zones' : self.zones }
+        try:
+            cfile = open(self.filename, 'w')
+            json.dump(catalog, cfile)
+            cfile.close()
+        except IOError:
+            print 'ERROR: cannot write catalog file', self.filename
+
+    # read the directory and file listing of an archive (nothing else gets inflated)
+    # Returns the archive record or None if the archive could not be loaded
+    def scanArchive(self, filename, st):
+        s3d = S3DFile(os.path.join(self.basepath, filename[:-4]), lazy=1)
+        if s3d.load(quiet=1) != 0:
+            return None
+
+        files = []
+        for entry in s3d.fileentries:
+            if entry.filename != None:
+                files.append([entry.filename, entry.size, entry.dir.crc, entry.dir.data_offset])
+        s3d.close()
+
+        return { 'filename' : filename, 'size' : st.st_size, 'mtime' : st.st_mtime, 'files' : files }
+
+    # bring the catalog up to date with the archives in basepath: only new archives and
+    # those whose size or mtime changed get scanned, the catalog is saved if anything changed
+    # Returns the number of archives that were (re)scanned
+    def update(self):
+        if len(self.archives) == 0:
+            self.load()
+
+        try:
+            filenames = os.listdir(self.basepath)
+        except OSError:
+            print 'ERROR: cannot read EQ directory', self.basepath
+            return 0
+
+        archives = {}
+        n_scanned = 0
+        for filename in filenames:
+            if not filename.lower().endswith('.s3d'):
+                continue
+
+            name = filename[:-4].lower()
+            try:
+                st = os.stat(os.path.join(self.basepath, filename))
+            except OSError:
+                continue
+
+            archive = self.archives.get(name)
+            if archive == None or archive['filename'] != filename or archive['size'] != st.st_size or \
+                archive['mtime'] != st.st_mtime:
+                archive = self.scanArchive(filename, st)
+                n_scanned += 1
+                if archive == None:
+                    print 'WARNING catalog: cannot load archive', filename
+                    continue
+
+            archives[name] = archive
+
+        changed = n_scanned > 0 or len(archives) != len(self.archives)
+        self.archives = archives
+        if changed:
+            self.buildZones()
+            self.save()
+        self.buildFileIndex()
+
+        return n_scanned
+
+    def buildZones(self):
+        self.zones = {}
+        for name in self.archives.keys():
+            wld_name = name + '.wld'
+            for f in self.archives[name]['files']:
+                if f[0] == wld_name:
+                    self.zones[name] = [name+suffix for suffix in ZONE_ARCHIVE_SUFFIXES if self.archives.has_key(name+suffix)]
+                    break
+
+    def buildFileIndex(self):
+        self.files = {}
+        for name in self.archives.keys():
+            for f in self.archives[name]['files']:
+                self.files.setdefault(f[0], []).append(name)
+
+    def hasZone(self, name):
+        return self.zones.has_key(name.lower())
+
+    # Returns the names of the archives making up the zone (empty if the zone does not exist)
+    def getZoneArchives(self, name):
+        return self.zones.get(name.lower(), [])
+
+    def hasArchive(self, name):
+        return self.archives.has_key(name.lower())
+
+    # Returns a list of the names of all archives holding the named file
+    def findFile(self, filename):
+        return self.files.get(filename.lower(), [])
+
+    # Returns the catalog entry [name, size, crc, data_offset] for a file in an archive or None
+    def getFileInfo(self, archive_name, filename):
+        archive = self.archives.get(archive_name.lower())
+        if archive != None:
+            filename = filename.lower()
+            for f in archive['files']:
+                if f[0] == filename:
+                    return f
+
+        return None
@@ -244,10 +244,91 @@ Placeable objects
 
 
 import struct, array
+from timeit import default_timer
+
+# numpy is optional: if it is there the bulk data of the 0x36 meshes is decoded straight into typed arrays
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 from file.wldfile import *
 
+# ------------------------------------------------------------------------------
+# fragment codec registry
+# every fragment type we know how to decode gets its Fragment class registered here (see the
+# bottom of this file), WLDFile.decodeFragment() dispatches through the registry
+# ------------------------------------------------------------------------------
+
+class FragmentCodecs():
+    def __init__(self):
+        self.codecs = {}            # fragment type -> Fragment class decoding it
+        self.decode_counts = {}     # fragment type -> number of fragments decoded
+        self.decode_times = {}      # fragment type -> total decode time in seconds
+        
+    def register(self, type, codec):
+        self.codecs[type] = codec
+        self.decode_counts[type] = 0
+        self.decode_times[type] = 0.0
+        
+    def types(self):
+        return sorted(self.codecs.keys(), reverse=True)
+        
+    # create and decode the fragment of the given type
+    # Returns the fragment object or None if there is no codec for this fragment type
+    def decode(self, id, type, nameRef, wld, buf, offset):
+        codec = self.codecs.get(type)
+        if codec == None:
+            return None
+            
+        start = default_timer()
+        fragment = codec(id, type, nameRef, wld)
+        fragment.decode(buf, offset)
+        self.decode_times[type] += default_timer() - start
+        self.decode_counts[type] += 1
+        return fragment
+        
+    def resetStats(self):
+        for type in self.codecs.keys():
+            self.decode_counts[type] = 0
+            self.decode_times[type] = 0.0
+            
+    def dumpStats(self):
+        for type in self.types():
+            if self.decode_counts[type] > 0:
+                print 'fragment type:0x%02x decoded:%i time:%.3fms' % \
+                    (type, self.decode_counts[type], self.decode_times[type]*1000.0)
+                    
+fragment_codecs = FragmentCodecs()
+
+# precompiled structs for arrays of count elements of one type, these get reused across fragments
+array_structs = {}
+
+def arrayStruct(format, count):
+    key = (format, count)
+    s = array_structs.get(key)
+    if s == None:
+        s = struct.Struct('<'+str(count)+format)
+        array_structs[key] = s
+    return s
+
+INT = struct.Struct('<i')
+USHORT = struct.Struct('<H')
+
+# Returns a numpy array of count elements of dtype viewing the wld buffer at offset (nothing gets copied)
+# Python 2's numpy.frombuffer() does not take memoryviews but numpy.asarray() does
+def numpyView(buf, dtype, offset, count):
+    dtype = numpy.dtype(dtype)
+    if isinstance(buf, memoryview):
+        return numpy.asarray(buf)[offset:offset+dtype.itemsize*count].view(dtype)
+    return numpy.frombuffer(buf, dtype, count, offset)
+
+
 class Fragment():
+    # the fixed part of the fragment data following the generic fragment header, 
+    # unpacked with unpack_from() straight out of the wld buffer
+    HEADER = None
+    
     def __init__(self, id, type, nameRef, wld):
         self.id = id
         self.type = type
@@ -259,8 +340,45 @@ class Fragment():
         f = self
         print 'FRAGMENT id:%i    TYPE: 0x%x    name:%s' % (f.id, f.type, f.wld.getName(self.nameRef))
         
+# Mesh Animated Vertices
+# every frame is a complete replacement of the vertex positions of the 0x36 mesh using it
+# with numpy frames is one (frameCount, vertexCount, 3) float32 array, otherwise a list holding
+# an array('f') of the flat x,y,z values per frame
+class Fragment37(Fragment):
+    HEADER = struct.Struct('<iHHHHH')
+    
+    def __init__(self, id, type, nameRef, wld):
+        Fragment.__init__(self, id, type, nameRef, wld)
+        
+    def decode(self, buf, offset):        
+        offset += 12    # skip over generic fragment header first
+        f = self
+        # delay is the time between frames in ms
+        (f.flags, f.vertexCount, f.frameCount, f.delay, f.params2, scale) = self.HEADER.unpack_from(buf, offset)
+        offset += self.HEADER.size
+        f.scale = 1.0/(1<<scale)
+        
+        if numpy != None:
+            vdata = numpyView(buf, '<i2', offset, f.frameCount*f.vertexCount*3)
+            f.frames = vdata.reshape(f.frameCount, f.vertexCount, 3) * numpy.float32(f.scale)
+        else:
+            s = arrayStruct('h', f.vertexCount*3)
+            f.frames = [array.array('f', [c*f.scale for c in s.unpack_from(buf, offset+i*s.size)]) 
+                for i in range(0, f.frameCount)]
+                
+    def dump(self):
+        Fragment.dump(self)
+        f = self
+        print 'flags:0x%x vertexCount:%i frameCount:%i delay:%i params2:%i scale:%f' % \
+            (f.flags, f.vertexCount, f.frameCount, f.delay, f.params2, f.scale)
+
 # Mesh Fragment
 class Fragment36(Fragment):
+    HEADER = struct.Struct('<iiiiifffiiifffffffhhhhhhhhhh')
+    
+    # polygon flag bits
+    POLY_PASSABLE = 0x10    # not solid: foliage etc, these don't take part in collisions
+    
     def __init__(self, id, type, nameRef, wld):
         Fragment.__init__(self, id, type, nameRef, wld)
         
@@ -273,89 +391,174 @@ class Fragment36(Fragment):
         # fragment2 is a 0x2f animated vertices fragment if this is a placeable
         # fragment3 and 4 are more or less unknown at this point
         offset += 12    # skip over generic fragment header first
-        (f.flags, f.fragment1, f.fragment2, f.fragment3, f.fragment4) = struct.unpack('<iiiii',buf[offset:offset+20])
-        offset += 20
-        (f.centerX, f.centerY, f.centerZ) = struct.unpack('<fff', buf[offset:offset+12])
-        offset += 12
-        (f.params2_0, f.params2_1, f.params2_2) = struct.unpack('<iii', buf[offset:offset+12])
-        offset += 12
-        (f.maxDist, f.minX, f.minY, f.minZ, f.maxX, f.maxY, f.maxZ,) = struct.unpack('<fffffff', buf[offset:offset+28])
-        offset += 28
-        (f.vertexCount, f.texCoordsCount, f.normalsCount, f.colorCount, f.polyCount) = struct.unpack('<hhhhh', buf[offset:offset+10])
-        offset += 10
-        (f.size6, f.polyTexCount, f.vertexTexCount, f.size9, scale) = struct.unpack('<hhhhh', buf[offset:offset+10])
-        offset += 10
+        (f.flags, f.fragment1, f.fragment2, f.fragment3, f.fragment4, 
+        f.centerX, f.centerY, f.centerZ, 
+        f.params2_0, f.params2_1, f.params2_2,
+        f.maxDist, f.minX, f.minY, f.minZ, f.maxX, f.maxY, f.maxZ,
+        f.vertexCount, f.texCoordsCount, f.normalsCount, f.colorCount, f.polyCount,
+        f.size6, f.polyTexCount, f.vertexTexCount, f.size9, scale) = self.HEADER.unpack_from(buf, offset)
+        offset += self.HEADER.size
     
         f.scale = 1.0/(1<<scale)
-    
+        
+        if numpy != None:
+            offset = self.decodeArraysNumpy(buf, offset)
+        else:
+            offset = self.decodeArrays(buf, offset)
+            
+        # skip size6 * 4 bytes (unknown)
+        offset += f.size6 *4
+        
+        # read polygon texture assignments
+        # each entry in polyTexList is a tuple: (pcount, texidx)
+        # denoting the number of consecutive polygons using texture texidx
+        # texidx is the index into the 0x31 texture list fragment 
+        # pcount is the number of consecutive polygons that use the same texture
+        # texidx references the entry in the 0x31 texture list fragment that this mesh uses
+        # polygons are grouped by the texture they use and the list here is in the same order
+        # therefore assignment is straight forward
+        s = arrayStruct('h', f.polyTexCount*2)
+        tdata = s.unpack_from(buf, offset)
+        offset += s.size
+        f.polyTexList = [(tdata[i], tdata[i+1]) for i in range(0, len(tdata), 2)]
+        
+    # numpy version of decodeArrays() below: each list becomes one typed array with a row per element
+    # vertexList, uvList and vertexNormalsList are float32 arrays, vertexColorsList holds the u32 rgba 
+    # values, polyList the u16 vertex indices of the triangles and polyFlags their u16 flags
+    # Returns the offset following the polygon data
+    def decodeArraysNumpy(self, buf, offset):
+        f = self
+        
+        # vertex data
+        vdata = numpyView(buf, '<i2', offset, f.vertexCount*3)
+        offset += vdata.nbytes
+        f.vertexList = vdata.reshape(-1, 3) * numpy.float32(f.scale)
+        
+        # texture u,v coordinates: careful, these differ between version 1 and 2 wld file
+        self.uvList = numpy.zeros((0, 2), numpy.float32)
+        if self.wld.version == Version1WLD:
+            vdata = numpyView(buf, '<i2', offset, f.texCoordsCount*2)
+            offset += vdata.nbytes
+            self.uvList = vdata.reshape(-1, 2) * numpy.float32(1.0 / 256.0)
+        if self.wld.version == Version2WLD:
+            vdata = numpyView(buf, '<f4', offset, f.texCoordsCount*2)
+            offset += vdata.nbytes
+            self.uvList = vdata.reshape(-1, 2) * numpy.array([1.0, -1.0], numpy.float32)
+            
+        # vertex normals
+        vdata = numpyView(buf, 'i1', offset, f.normalsCount*3)
+        offset += vdata.nbytes
+        f.vertexNormalsList = vdata.reshape(-1, 3) * numpy.float32(1.0 / 127.0)
+        
+        # vertex colors: 32bit rgba
+        f.vertexColorsList = numpyView(buf, '<u4', offset, f.colorCount)
+        offset += f.vertexColorsList.nbytes
+        
+        # polygons: u16 flag followed by 3 u16 vertex indices
+        pdata = numpyView(buf, '<u2', offset, f.polyCount*4)
+        offset += pdata.nbytes
+        f.polyList = pdata.reshape(-1, 4)[:, 1:4]
+        f.polyFlags = pdata.reshape(-1, 4)[:, 0]
+        
+        return offset
+        
+    # read the vertices, uvs, normals, colors and polygons into lists with one entry per element
+    # Returns the offset following the polygon data
+    def decodeArrays(self, buf, offset):
+        f = self
+        
         # read vertex data
-        f.vertexList = []
-        for i in range(0, f.vertexCount):
-            vdata = struct.unpack('<hhh', buf[offset:offset+6])
-            offset += 6
-            vertex = array.array('f', (vdata[0]*f.scale, vdata[1]*f.scale, vdata[2]*f.scale) )
-            f.vertexList.append(vertex)
+        s = arrayStruct('h', f.vertexCount*3)
+        vdata = s.unpack_from(buf, offset)
+        offset += s.size
+        scale = f.scale
+        f.vertexList = [array.array('f', (vdata[i]*scale, vdata[i+1]*scale, vdata[i+2]*scale)) \
+            for i in range(0, len(vdata), 3)]
 
         # read texture u,v coordinates: careful, these differ between version 1 and 2 wld file
         self.uvList = []
         recip_255 = 1.0 / 256.0
         if self.wld.version == Version1WLD:
-            for i in range(0, f.texCoordsCount):    
-                vdata = struct.unpack('<hh', buf[offset:offset+4])
-                offset += 4
-                uvdata = array.array('f', (vdata[0]*recip_255, vdata[1]*recip_255))
-                self.uvList.append(uvdata)
+            s = arrayStruct('h', f.texCoordsCount*2)
+            vdata = s.unpack_from(buf, offset)
+            offset += s.size
+            self.uvList = [array.array('f', (vdata[i]*recip_255, vdata[i+1]*recip_255)) \
+                for i in range(0, len(vdata), 2)]
         if self.wld.version == Version2WLD:
-            for i in range(0, f.texCoordsCount):    
-                vdata = struct.unpack('<ff', buf[offset:offset+8])
-                offset += 8
-                # print vdata[0], vdata[1]
-                uvdata = array.array('f', (vdata[0], 0.0-vdata[1]))
-                self.uvList.append(uvdata)
+            s = arrayStruct('f', f.texCoordsCount*2)
+            vdata = s.unpack_from(buf, offset)
+            offset += s.size
+            self.uvList = [array.array('f', (vdata[i], 0.0-vdata[i+1])) for i in range(0, len(vdata), 2)]
         
         # Vertex normals
-        f.vertexNormalsList = []
         recip_127 = 1.0 / 127.0
-        for i in range(0, f.normalsCount):
-            vdata = struct.unpack('<bbb', buf[offset:offset+3])
-            offset += 3
-            vnormal = array.array('f', (vdata[0]*recip_127, vdata[1]*recip_127, vdata[2]*recip_127) )
-            f.vertexNormalsList.append(vnormal)
+        s = arrayStruct('b', f.normalsCount*3)
+        vdata = s.unpack_from(buf, offset)
+        offset += s.size
+        f.vertexNormalsList = [array.array('f', (vdata[i]*recip_127, vdata[i+1]*recip_127, vdata[i+2]*recip_127)) \
+            for i in range(0, len(vdata), 3)]
 
         # Vertex colors: 32bit rgba
-        f.vertexColorsList = []
-        for i in range(0, f.colorCount):
-            (rgba,) = struct.unpack('<I', buf[offset:offset+4])
-            offset += 4
-            # print 'RGBA 0x%x' % (rgba)
-            f.vertexColorsList.append(rgba)
+        s = arrayStruct('I', f.colorCount)
+        f.vertexColorsList = list(s.unpack_from(buf, offset))
+        offset += s.size
         
         # read polygon data (actually this is a misnomer as the fixed length structure in the wld for these 
         # does only allow triangles; I've kept the naming in order to stay in line with the available documentation)
-        f.polyList = []
-        for i in range(0, f.polyCount):
-            (pflag,) = struct.unpack('<H', buf[offset:offset+2])
-            offset += 2
-            pverts = struct.unpack('<HHH', buf[offset:offset+6])
-            offset += 6
-            f.polyList.append(pverts)   # NOTE: we do not store the flags currently!
+        # each polygon is a u16 flag followed by 3 u16 vertex indices
+        s = arrayStruct('H', f.polyCount*4)
+        pdata = s.unpack_from(buf, offset)
+        offset += s.size
+        f.polyList = [pdata[i+1:i+4] for i in range(0, len(pdata), 4)]
+        f.polyFlags = array.array('H', pdata[0::4])     # the flags go into their own packed array
+        
+        return offset
+        
+    # Returns the 0x31 texture list index of every polygon (expanded from the polyTexList runs)
+    # polygons not covered by the runs get -1
+    def getPolygonTextureIndices(self):
+        tex_indices = []
+        for (pcount, texidx) in self.polyTexList:
+            tex_indices.extend([texidx] * pcount)
             
-        # skip size6 * 4 bytes (unknown)
-        offset += f.size6 *4
+        n_polys = len(self.polyList)
+        return tex_indices[0:n_polys] + [-1] * (n_polys - len(tex_indices))
         
-        # read polygon texture assignments
-        # each entry in polyTexList is a tuple: (pcount, texidx)
-        # denoting the number of consecutive polygons using texture texidx
-        # texidx is the index into the 0x31 texture list fragment 
-        f.polyTexList = []
-        for i in range(0, f.polyTexCount):
-            # pcount is the number of consecutive polygons that use the same texture
-            # texidx references the entry in the 0x31 texture list fragment that this mesh uses
-            # polygons are grouped by the texture they use and the list here is in the same order
-            # therefore assignment is straight forward
-            (pcount, texidx) = struct.unpack('<hh', buf[offset:offset+4])
-            offset += 4
-            f.polyTexList.append((pcount,texidx))
+    # split the polygons into three sets of polygon indices:
+    #   solid: drawn and collided with
+    #   passable: drawn (unless invisible) but left out of collisions (POLY_PASSABLE set)
+    #   invisible: not drawn but still collided with (zone walls), these use one of the texture 
+    #              list indices in invisible_textures
+    # Returns the tuple of lists (solid, passable, invisible)
+    def splitPolygons(self, invisible_textures=()):
+        if numpy != None and not isinstance(self.polyFlags, array.array):
+            passable = (self.polyFlags & Fragment36.POLY_PASSABLE) != 0
+            tex_indices = numpy.array(self.getPolygonTextureIndices(), numpy.int32)
+            invisible = numpy.in1d(tex_indices, numpy.array(invisible_textures, numpy.int32)) & ~passable
+            solid = ~(passable | invisible)
+            return (numpy.flatnonzero(solid).tolist(), numpy.flatnonzero(passable).tolist(), 
+                numpy.flatnonzero(invisible).tolist())
+                
+        solid = []
+        passable = []
+        invisible = []
+        tex_indices = self.getPolygonTextureIndices()
+        for i in range(0, len(self.polyFlags)):
+            if self.polyFlags[i] & Fragment36.POLY_PASSABLE:
+                passable.append(i)
+            elif tex_indices[i] in invisible_textures:
+                invisible.append(i)
+            else:
+                solid.append(i)
+                
+        return (solid, passable, invisible)
+        
+    # Returns the indices of all polygons that take part in collisions
+    def getCollisionPolygons(self):
+        if numpy != None and not isinstance(self.polyFlags, array.array):
+            return numpy.flatnonzero((self.polyFlags & Fragment36.POLY_PASSABLE) == 0).tolist()
+            
+        return [i for i in range(0, len(self.polyFlags)) if not self.polyFlags[i] & Fragment36.POLY_PASSABLE]
                 
     def dump(self):
         Fragment.dump(self)
@@ -369,19 +572,17 @@ class Fragment36(Fragment):
 
 # Texture List
 class Fragment31(Fragment):
+    HEADER = struct.Struct('<ii')
+    
     def __init__(self, id, type, nameRef, wld):
         Fragment.__init__(self, id, type, nameRef, wld)
         
     def decode(self, buf, offset):        
         offset += 12    # skip over generic fragment header first
         f = self
-        (f.flags, f.numNameRefs) = struct.unpack('<ii',  buf[offset:offset+8])
-        offset += 8
-        self.nameRefs = []
-        for i in range(0, f.numNameRefs):
-            (nameRef,) = struct.unpack('<I',  buf[offset:offset+4])
-            offset += 4
-            self.nameRefs.append(nameRef)
+        (f.flags, f.numNameRefs) = self.HEADER.unpack_from(buf, offset)
+        offset += self.HEADER.size
+        self.nameRefs = list(arrayStruct('I', f.numNameRefs).unpack_from(buf, offset))
             
     def dump(self):
         Fragment.dump(self)
@@ -392,14 +593,15 @@ class Fragment31(Fragment):
         
 # Texture Reference
 class Fragment30(Fragment):
+    HEADER = struct.Struct('<iIiffI')
+    
     def __init__(self, id, type, nameRef, wld):
         Fragment.__init__(self, id, type, nameRef, wld)
         
     def decode(self, buf, offset):        
         offset += 12    # skip over generic fragment header first
         f = self
-        (f.flags, f.params1, f.params2, f.params3_1, f.params3_2, f.frag05Ref ) = struct.unpack('<iIiffI',  buf[offset:offset+24])
-        offset += 24
+        (f.flags, f.params1, f.params2, f.params3_1, f.params3_2, f.frag05Ref ) = self.HEADER.unpack_from(buf, offset)
         # note that we do not read&store the "datapair" that can follow here if Bit 1 of flags is set.
         # Its purpose is unknown anyway currently 
         
@@ -409,47 +611,495 @@ class Fragment30(Fragment):
         print 'frag05Ref:%i flags:0x%x params1:0x%x params2:0x%x params3_1:%f params3_2:%f' % \
         (f.frag05Ref, f.flags, f.params1, f.params2, f.params3_1, f.params3_2)
 
+# Mesh Animated Vertices Reference
+class Fragment2F(Fragment):
+    HEADER = struct.Struct('<ii')
+    
+    def __init__(self, id, type, nameRef, wld):
+        Fragment.__init__(self, id, type, nameRef, wld)
+        
+    def decode(self, buf, offset):        
+        offset += 12    # skip over generic fragment header first
+        f = self
+        (f.fragRef, f.flags) = self.HEADER.unpack_from(buf, offset)
+        
+    def dump(self):
+        Fragment.dump(self)
+        f = self
+        print 'fragRef:%i flags:0x%x' % (f.fragRef, f.flags)
+
 # Mesh - Reference
 class Fragment2D(Fragment):
+    HEADER = struct.Struct('<ii')
+    
+    def __init__(self, id, type, nameRef, wld):
+        Fragment.__init__(self, id, type, nameRef, wld)
+        
+    def decode(self, buf, offset):        
+        offset += 12    # skip over generic fragment header first
+        f = self
+        (f.fragRef, f.flags  ) = self.HEADER.unpack_from(buf, offset)
+        
+    def dump(self):
+        Fragment.dump(self)
+        f = self
+        print 'fragRef:%i flags:0x%x' % (f.fragRef, f.flags)
+
+
+# Ambient Light
+# fragRef is the 0x1C light source reference, regions are the (0 based) regions the light applies to
+class Fragment2A(Fragment):
+    HEADER = struct.Struct('<iii')
+    
+    def __init__(self, id, type, nameRef, wld):
+        Fragment.__init__(self, id, type, nameRef, wld)
+        
+    def decode(self, buf, offset):        
+        offset += 12    # skip over generic fragment header first
+        f = self
+        (f.fragRef, f.flags, f.numRegions) = self.HEADER.unpack_from(buf, offset)
+        offset += self.HEADER.size
+        f.regions = list(arrayStruct('i', f.numRegions).unpack_from(buf, offset))
+        
+    def dump(self):
+        Fragment.dump(self)
+        f = self
+        print 'fragRef:%i flags:0x%x numRegions:%i' % (f.fragRef, f.flags, f.numRegions)
+
+
+# region flag bits, see Fragment29
+REGION_WATER = 0x01
+REGION_LAVA = 0x02
+REGION_PVP = 0x04
+REGION_ZONELINE = 0x08
+
+# the region flag fragment names start with one of these, the longest prefixes come first
+REGION_PREFIXES = [('DRNTP', REGION_ZONELINE), ('DRP', REGION_PVP), ('WT', REGION_WATER), ('LA', REGION_LAVA)]
+
+# Zone line destination parsed from a DRNTP region flag name, e.g. DRNTP00025-02698-645.6-00020999_ZONE:
+# zone id (5 digits), x, y, z (6 characters each) and heading (3 digits)
+# coordinates of 999999 and a heading of 999 mean the current value is kept, these are None
+class ZoneLine():
+    def __init__(self, zone_id, x, y, z, heading):
+        self.zone_id = zone_id
+        self.x = x
+        self.y = y
+        self.z = z
+        self.heading = heading
+        
+    # Returns a ZoneLine or None if the name does not hold a valid destination
+    @staticmethod
+    def fromName(name):
+        fields = name[5:31]
+        if len(fields) != 26:
+            return None
+        try:
+            zone_id = int(fields[0:5])
+            coords = [float(fields[i:i+6]) for i in (5, 11, 17)]
+            heading = int(fields[23:26])
+        except ValueError:
+            return None
+            
+        coords = [None if c == 999999 else c for c in coords]
+        if heading == 999:
+            heading = None
+        return ZoneLine(zone_id, coords[0], coords[1], coords[2], heading)
+        
+    def __str__(self):
+        return 'zone:%i x:%s y:%s z:%s heading:%s' % (self.zone_id, self.x, self.y, self.z, self.heading)
+        
+# Region Flag
+# the fragment name tells what the listed (0 based) regions are, see REGION_PREFIXES
+class Fragment29(Fragment):
+    HEADER = struct.Struct('<ii')
+    
+    def __init__(self, id, type, nameRef, wld):
+        Fragment.__init__(self, id, type, nameRef, wld)
+        
+    def decode(self, buf, offset):        
+        offset += 12    # skip over generic fragment header first
+        f = self
+        (f.flags, f.numRegions) = self.HEADER.unpack_from(buf, offset)
+        offset += self.HEADER.size
+        f.regions = list(arrayStruct('i', f.numRegions).unpack_from(buf, offset))
+        offset += f.numRegions*4
+        
+        # the optional user data string is namehash encoded
+        (size,) = INT.unpack_from(buf, offset)
+        offset += 4
+        f.userData = ''
+        if size > 0:
+            f.userData = str(f.wld.decodeBytes(bytearray(buf[offset:offset+size]))).rstrip('\0')
+        
+        f.regionFlags = 0
+        for (prefix, flag) in REGION_PREFIXES:
+            if f.name.startswith(prefix):
+                f.regionFlags = flag
+                break
+                
+        f.zoneLine = None
+        if f.regionFlags == REGION_ZONELINE:
+            f.zoneLine = ZoneLine.fromName(f.name)
+            
+    def dump(self):
+        Fragment.dump(self)
+        f = self
+        print 'flags:0x%x regionFlags:0x%x numRegions:%i userData:%s' % (f.flags, f.regionFlags, f.numRegions, f.userData)
+        if f.zoneLine != None:
+            print 'zone line to', f.zoneLine
+
+
+# Light Info: a placed point light
+# fragRef is the 0x1C light source reference
+class Fragment28(Fragment):
+    HEADER = struct.Struct('<iiffff')
+    
+    def __init__(self, id, type, nameRef, wld):
+        Fragment.__init__(self, id, type, nameRef, wld)
+        
+    def decode(self, buf, offset):        
+        offset += 12    # skip over generic fragment header first
+        f = self
+        (f.fragRef, f.flags, f.x, f.y, f.z, f.radius) = self.HEADER.unpack_from(buf, offset)
+        
+    def dump(self):
+        Fragment.dump(self)
+        f = self
+        print 'fragRef:%i flags:0x%x x:%f y:%f z:%f radius:%f' % (f.fragRef, f.flags, f.x, f.y, f.z, f.radius)
+
+
+# Returns the list of region indices encoded in a run length encoded 0x22 region list
+# the list walks over the region indices starting at 0, each byte either skips regions or 
+# adds regions to the list:
+#   0x00-0x3E   skip that many regions
+#   0x3F        skip the number of regions in the following u16
+#   0x40-0x7F   skip bits 3-5 regions, then add bits 0-2 regions
+#   0x80-0xBF   add bits 3-5 regions, then skip bits 0-2 regions
+#   0xC0-0xFE   add (byte - 0xC0) regions
+#   0xFF        add the number of regions in the following u16
+def decodeRegionList(buf, offset, size):
+    data = bytearray(buf[offset:offset+size])
+    regions = []
+    region = 0
+    i = 0
+    while i < size:
+        b = data[i]
+        if b < 0x3F:
+            region += b
+        elif b == 0x3F:
+            if i+2 >= size:
+                break
+            region += data[i+1] | (data[i+2] << 8)
+            i += 2
+        elif b < 0x80:
+            region += (b & 0x38) >> 3
+            regions.extend(range(region, region + (b & 0x07)))
+            region += b & 0x07
+        elif b < 0xC0:
+            regions.extend(range(region, region + ((b & 0x38) >> 3)))
+            region += ((b & 0x38) >> 3) + (b & 0x07)
+        elif b < 0xFF:
+            regions.extend(range(region, region + b - 0xC0))
+            region += b - 0xC0
+        else:
+            if i+2 >= size:
+                break
+            count = data[i+1] | (data[i+2] << 8)
+            regions.extend(range(region, region + count))
+            region += count
+            i += 2
+        i += 1
+        
+    return regions
+
+# BSP Region
+# all the variable sized data areas are skipped except for the first Data6 entry: that's the
+# list of regions visible from this one (the "nearby" regions), it only gets decoded on demand
+class Fragment22(Fragment):
+    HEADER = struct.Struct('<iiiiiiiiii')
+    
+    # region flag bits
+    HAS_SPHERE = 0x01       # a bounding sphere (x, y, z, radius) follows the visible regions list
+    HAS_REVERB_VOLUME = 0x02    # followed by a reverb volume (4 bytes)
+    HAS_REVERB_OFFSET = 0x04    # followed by a reverb offset (4 bytes)
+    PVS_WORDS = 0x20        # the visible regions list holds u16 region numbers instead of the rle bytes
+    HAS_MESH = 0x100        # the region references a 0x36 mesh
+    
     def __init__(self, id, type, nameRef, wld):
         Fragment.__init__(self, id, type, nameRef, wld)
+        self.visibleRegions = None
         
     def decode(self, buf, offset):        
+        # the variable sized areas are walked using sizes read from the data, anything pointing
+        # outside of this fragment means we got the layout wrong: then the region gets no
+        # visible regions list and no mesh rather than garbage
+        (length,) = INT.unpack_from(buf, offset)
+        end = offset + 8 + length   # the length field counts everything following the type field
+        
         offset += 12    # skip over generic fragment header first
         f = self
-        (f.fragRef, f.flags  ) = struct.unpack('<ii',  buf[offset:offset+8])
-        offset += 8
+        (f.flags, f.fragment1, f.size1, f.size2, f.params1, f.size3, f.size4, f.params2, 
+        f.size5, f.size6) = self.HEADER.unpack_from(buf, offset)
+        offset += self.HEADER.size
+        
+        f.hasPvs = 0
+        f.pvsOffset = 0
+        f.pvsSize = 0       # number of bytes (or u16 region numbers) in the visible regions list
+        f.size7 = 0
+        f.meshRef = 0
+        
+        offset += f.size1*12 + f.size2*8
+        for i in range(0, f.size3):
+            if offset < 0 or offset + 8 > end:
+                return
+            (size,) = INT.unpack_from(buf, offset+4)
+            offset += 8 + size*4
+        offset += f.size4*4 + f.size5*28
+        
+        for i in range(0, f.size6):
+            if offset < 0 or offset + 2 > end:
+                return
+            (size,) = USHORT.unpack_from(buf, offset)
+            offset += 2
+            if i == 0:
+                pvs_offset = offset
+                pvs_size = size
+            if f.flags & self.PVS_WORDS:
+                offset += size*2
+            else:
+                offset += size
+        if f.size6 > 0 and offset <= end:
+            f.hasPvs = 1
+            f.pvsOffset = pvs_offset
+            f.pvsSize = pvs_size
+            
+        # optional fields ahead of the user data
+        if f.flags & self.HAS_SPHERE:
+            offset += 16
+        if f.flags & self.HAS_REVERB_VOLUME:
+            offset += 4
+        if f.flags & self.HAS_REVERB_OFFSET:
+            offset += 4
+            
+        if offset < 0 or offset + 4 > end:
+            return
+        (size7,) = INT.unpack_from(buf, offset)
+        offset += 4 + size7
+        if size7 < 0 or offset > end:
+            return
+        f.size7 = size7
+        
+        if f.flags & self.HAS_MESH and offset + 4 <= end:
+            (f.meshRef,) = INT.unpack_from(buf, offset)
+            
+    # Returns the indices of the regions visible from this one or None if the region has no such list
+    def getVisibleRegions(self):
+        if self.visibleRegions == None and self.hasPvs == 1:
+            if self.flags & self.PVS_WORDS:
+                numbers = arrayStruct('H', self.pvsSize).unpack_from(self.wld.data, self.pvsOffset)
+                self.visibleRegions = [n-1 for n in numbers]
+            else:
+                self.visibleRegions = decodeRegionList(self.wld.data, self.pvsOffset, self.pvsSize)
+                
+        return self.visibleRegions
+        
+    def dump(self):
+        Fragment.dump(self)
+        f = self
+        print 'flags:0x%x size1:%i size2:%i size3:%i size4:%i size5:%i size6:%i size7:%i' % \
+            (f.flags, f.size1, f.size2, f.size3, f.size4, f.size5, f.size6, f.size7)
+        print 'pvsSize:%i meshRef:%i' % (f.pvsSize, f.meshRef)
+
+# BSP Tree
+# each node is a tuple (normalX, normalY, normalZ, splitDistance, regionId, left, right) 
+# left and right are 1 based node indices (0 = no such node), a non zero regionId makes the
+# node a leaf: the region is the 0x22 fragment with that (1 based) number
+class Fragment21(Fragment):
+    HEADER = struct.Struct('<i')
+    NODE = struct.Struct('<ffffiii')
+    
+    if numpy != None:
+        NODE_DTYPE = numpy.dtype([('normalX', '<f4'), ('normalY', '<f4'), ('normalZ', '<f4'), 
+            ('splitDistance', '<f4'), ('regionId', '<i4'), ('left', '<i4'), ('right', '<i4')])
+    
+    def __init__(self, id, type, nameRef, wld):
+        Fragment.__init__(self, id, type, nameRef, wld)
+        
+    def decode(self, buf, offset):        
+        offset += 12    # skip over generic fragment header first
+        f = self
+        (f.numNodes,) = self.HEADER.unpack_from(buf, offset)
+        offset += self.HEADER.size
+        
+        # the tree gets walked node by node in python, plain tuples are the fastest to do that with
+        if numpy != None:
+            f.nodes = numpyView(buf, self.NODE_DTYPE, offset, f.numNodes).tolist()
+        else:
+            f.nodes = [self.NODE.unpack_from(buf, offset + i*self.NODE.size) for i in range(0, f.numNodes)]
+            
+    # Returns the index of the region (0 based) the point lies in or -1 if it's not in any region
+    # points on the split plane or in front of it go left
+    def findRegion(self, x, y, z):
+        nodes = self.nodes
+        if len(nodes) == 0:
+            return -1
+            
+        node = nodes[0]
+        depth = 0
+        while node[4] == 0:
+            if node[0]*x + node[1]*y + node[2]*z + node[3] >= 0:
+                child = node[5]
+            else:
+                child = node[6]
+                
+            depth += 1
+            if child <= 0 or child > len(nodes) or depth > len(nodes):
+                return -1
+            node = nodes[child-1]
+            
+        return node[4] - 1
+        
+    # Returns the indices of the regions (0 based) the line segment from p0 to p1 passes through,
+    # in order from p0 to p1. The segment gets split at each node plane it crosses, the part on 
+    # p0's side is followed first
+    def findRegionsAlongSegment(self, x0, y0, z0, x1, y1, z1):
+        nodes = self.nodes
+        regions = []
+        if len(nodes) == 0:
+            return regions
+            
+        dx = x1 - x0
+        dy = y1 - y0
+        dz = z1 - z0
+        stack = [(1, 0.0, 1.0)]     # (1 based node index, start and end of the segment part as fractions)
+        steps = 0
+        while len(stack) > 0 and steps <= 2*len(nodes):   # every node gets visited once at most, unless the tree is broken
+            steps += 1
+            (index, t0, t1) = stack.pop()
+            if index <= 0 or index > len(nodes):
+                continue
+            node = nodes[index-1]
+            if node[4] != 0:
+                regions.append(node[4] - 1)
+                continue
+                
+            d = node[0]*x0 + node[1]*y0 + node[2]*z0 + node[3]
+            dd = node[0]*dx + node[1]*dy + node[2]*dz
+            d0 = d + dd*t0
+            d1 = d + dd*t1
+            if d0 >= 0 and d1 >= 0:
+                stack.append((node[5], t0, t1))
+            elif d0 < 0 and d1 < 0:
+                stack.append((node[6], t0, t1))
+            else:
+                t = -d / dd
+                if d0 >= 0:
+                    stack.append((node[6], t, t1))
+                    stack.append((node[5], t0, t))
+                else:
+                    stack.append((node[5], t, t1))
+                    stack.append((node[6], t0, t))
+                    
+        return regions
+        
+    def dump(self):
+        Fragment.dump(self)
+        print 'numNodes:%i' % (self.numNodes)
+
+# Light Source Reference
+class Fragment1C(Fragment):
+    HEADER = struct.Struct('<ii')
+    
+    def __init__(self, id, type, nameRef, wld):
+        Fragment.__init__(self, id, type, nameRef, wld)
+        
+    def decode(self, buf, offset):        
+        offset += 12    # skip over generic fragment header first
+        f = self
+        (f.fragRef, f.flags) = self.HEADER.unpack_from(buf, offset)
         
     def dump(self):
         Fragment.dump(self)
         f = self
         print 'fragRef:%i flags:0x%x' % (f.fragRef, f.flags)
 
+# Light Source
+# a light can have several frames, each with a light level and/or a color
+# the optional fields are there according to the flags
+class Fragment1B(Fragment):
+    HEADER = struct.Struct('<ii')
+    
+    # flag bits
+    HAS_CURRENT_FRAME = 0x01
+    HAS_SLEEP = 0x02
+    HAS_LIGHT_LEVELS = 0x04
+    SKIP_FRAMES = 0x08
+    HAS_COLORS = 0x10
+    
+    def __init__(self, id, type, nameRef, wld):
+        Fragment.__init__(self, id, type, nameRef, wld)
+        
+    def decode(self, buf, offset):        
+        offset += 12    # skip over generic fragment header first
+        f = self
+        (f.flags, f.frameCount) = self.HEADER.unpack_from(buf, offset)
+        offset += self.HEADER.size
+        
+        f.currentFrame = 0
+        f.sleep = 0
+        f.lightLevels = []
+        f.colors = []
+        if f.flags & self.HAS_CURRENT_FRAME:
+            (f.currentFrame,) = INT.unpack_from(buf, offset)
+            offset += 4
+        if f.flags & self.HAS_SLEEP:
+            (f.sleep,) = INT.unpack_from(buf, offset)
+            offset += 4
+        if f.flags & self.HAS_LIGHT_LEVELS:
+            f.lightLevels = list(arrayStruct('f', f.frameCount).unpack_from(buf, offset))
+            offset += f.frameCount*4
+        if f.flags & self.HAS_COLORS:
+            data = arrayStruct('f', f.frameCount*3).unpack_from(buf, offset)
+            f.colors = [data[i:i+3] for i in range(0, len(data), 3)]
+            
+    # Returns the (r, g, b) color of the first frame, scaled by its light level
+    def getColor(self):
+        level = 1.0
+        if len(self.lightLevels) > 0:
+            level = self.lightLevels[0]
+        if len(self.colors) > 0:
+            return (self.colors[0][0]*level, self.colors[0][1]*level, self.colors[0][2]*level)
+        return (level, level, level)
+        
+    def dump(self):
+        Fragment.dump(self)
+        f = self
+        print 'flags:0x%x frameCount:%i currentFrame:%i sleep:%i' % (f.flags, f.frameCount, f.currentFrame, f.sleep)
+        print 'lightLevels:', f.lightLevels
+        print 'colors:', f.colors
+
 
 # Object Location - Reference
 class Fragment15(Fragment):
+    HEADER = struct.Struct('<iiifffffffffi')
+    
     def __init__(self, id, type, nameRef, wld):
         Fragment.__init__(self, id, type, nameRef, wld)
         
     def decode(self, buf, offset):        
         offset += 12    # skip over generic fragment header first
         f = self
-        (f.fragRef, f.flags, f.fragRef1 ) = struct.unpack('<iii',  buf[offset:offset+12])
-        offset += 12
+        (f.fragRef, f.flags, f.fragRef1, 
+        f.xpos, f.ypos, f.zpos, f.xrot, f.yrot, f.zrot, 
+        f.xscale, f.yscale, f.zscale, 
+        f.fragRef2) = self.HEADER.unpack_from(buf, offset)
+        offset += self.HEADER.size
         
         # for convenience (and performance) reasons we do the name ref lookup here already
         self.refName = self.wld.getName(self.fragRef)
         
-        (self.xpos, self.ypos, self.zpos, self.xrot, self.yrot, self.zrot) = \
-            struct.unpack('<ffffff', buf[offset:offset+24])
-        offset += 24
-        (self.xscale, self.yscale, self.zscale) = \
-            struct.unpack('<fff', buf[offset:offset+12])
-        offset += 12
-        (f.fragRef2, ) = struct.unpack('<i',  buf[offset:offset+4])
-        offset += 4
         if f.fragRef2 != 0:
-            (f.params2, ) = struct.unpack('<i',  buf[offset:offset+4])
+            (f.params2, ) = INT.unpack_from(buf, offset)
         else:
             f.params2 = 0
         
@@ -464,14 +1114,16 @@ class Fragment15(Fragment):
         
 # Static or animated Model (Placeable / Mob)
 class Fragment14(Fragment):
+    HEADER = struct.Struct('<iiiii')
+    
     def __init__(self, id, type, nameRef, wld):
         Fragment.__init__(self, id, type, nameRef, wld)
         
     def decode(self, buf, offset):        
         offset += 12    # skip over generic fragment header first
         f = self
-        (f.flags, f.fragRef1, f.size1, f.size2, f.fragRef2 ) = struct.unpack('<iiiii',  buf[offset:offset+20])
-        offset += 20
+        (f.flags, f.fragRef1, f.size1, f.size2, f.fragRef2 ) = self.HEADER.unpack_from(buf, offset)
+        offset += self.HEADER.size
 
         if f.flags & (1 << 0):
             offset += 4         # skip params1 for now if its there
@@ -479,17 +1131,18 @@ class Fragment14(Fragment):
             offset += 4         # same for params2
 
         for i in range(0, f.size1):
-            (size, ) = struct.unpack('<i',  buf[offset:offset+4])
+            (size, ) = INT.unpack_from(buf, offset)
             offset += 4
             offset += size*8    # skip size DATAPAIRS (unknown purpose)
 
-        self.fragRefs3 = []
-        for i in range(0, f.size2):
-            (fragRef3, ) = struct.unpack('<i',  buf[offset:offset+4])
-            self.fragRefs3.append(fragRef3)
-            offset += 4
+        # these are the refs to the 0x2d mesh refs (static) or 0x11 skeleton refs (animated)
+        if numpy != None:
+            self.fragRefs3 = numpyView(buf, '<i4', offset, f.size2)
+        else:
+            self.fragRefs3 = list(arrayStruct('i', f.size2).unpack_from(buf, offset))
+        offset += f.size2*4
 
-        (size, ) = struct.unpack('<i',  buf[offset:offset+4])
+        (size, ) = INT.unpack_from(buf, offset)
         offset += 4
         offset += size
 
@@ -502,14 +1155,15 @@ class Fragment14(Fragment):
 
 # Mob Skeleton Piece Track - Reference
 class Fragment13(Fragment):
+    HEADER = struct.Struct('<ii')
+    
     def __init__(self, id, type, nameRef, wld):
         Fragment.__init__(self, id, type, nameRef, wld)
         
     def decode(self, buf, offset):        
         offset += 12    # skip over generic fragment header first
         f = self
-        (f.fragRef, f.params1  ) = struct.unpack('<ii',  buf[offset:offset+8])
-        offset += 8
+        (f.fragRef, f.params1  ) = self.HEADER.unpack_from(buf, offset)
         
     def dump(self):
         Fragment.dump(self)
@@ -518,24 +1172,25 @@ class Fragment13(Fragment):
 
 # Mob Skeleton Piece Track
 class Fragment12(Fragment):
+    HEADER = struct.Struct('<iiHHHHHHHH')
+    
     def __init__(self, id, type, nameRef, wld):
         Fragment.__init__(self, id, type, nameRef, wld)
         
     def decode(self, buf, offset):        
         offset += 12    # skip over generic fragment header first
         f = self
-        (f.flags, f.size  ) = struct.unpack('<ii',  buf[offset:offset+8])
-        offset += 8
-        (f.rotDenom, f.rotx, f.roty, f.rotz) = struct.unpack('<HHHH',  buf[offset:offset+8])
-        offset += 8
-        (f.shiftx, f.shifty, f.shiftz, f.shiftDenom) = struct.unpack('<HHHH',  buf[offset:offset+8])
-        offset += 8
-
-        f.data2 = []
-        for i in range(0, f.size):
-            data2 = struct.unpack('<iiii',  buf[offset:offset+16])
-            offset += 16
-            f.data2.append(data2)
+        (f.flags, f.size, 
+        f.rotDenom, f.rotx, f.roty, f.rotz,
+        f.shiftx, f.shifty, f.shiftz, f.shiftDenom) = self.HEADER.unpack_from(buf, offset)
+        offset += self.HEADER.size
+
+        # the track frames: an (size, 4) int32 array with numpy, a list of 4-tuples otherwise
+        if numpy != None:
+            f.data2 = numpyView(buf, '<i4', offset, f.size*4).reshape(-1, 4)
+        else:
+            data2 = arrayStruct('i', f.size*4).unpack_from(buf, offset)
+            f.data2 = [data2[i:i+4] for i in range(0, len(data2), 4)]
         
     def dump(self):
         Fragment.dump(self)
@@ -546,14 +1201,15 @@ class Fragment12(Fragment):
 
 # Animation Track - Reference
 class Fragment11(Fragment):
+    HEADER = struct.Struct('<ii')
+    
     def __init__(self, id, type, nameRef, wld):
         Fragment.__init__(self, id, type, nameRef, wld)
         
     def decode(self, buf, offset):        
         offset += 12    # skip over generic fragment header first
         f = self
-        (f.fragRef, f.params1  ) = struct.unpack('<ii',  buf[offset:offset+8])
-        offset += 8
+        (f.fragRef, f.params1  ) = self.HEADER.unpack_from(buf, offset)
         
     def dump(self):
         Fragment.dump(self)
@@ -562,50 +1218,83 @@ class Fragment11(Fragment):
 
 # Skeleton Track Set
 class Fragment10(Fragment):
+    HEADER = struct.Struct('<iii')
+    PARAMS1 = struct.Struct('<iii')
+    PARAMS2 = struct.Struct('<f')
+    ENTRY = struct.Struct('<iiiii')
+    
+    # the fixed fields of the skeleton entries
+    if numpy != None:
+        ENTRY_DTYPE = numpy.dtype([('nameRef', '<i4'), ('flags', '<i4'), ('fragRef1', '<i4'), ('fragRef2', '<i4'), 
+            ('size', '<i4')])
+    
     def __init__(self, id, type, nameRef, wld):
         Fragment.__init__(self, id, type, nameRef, wld)
         
     def decode(self, buf, offset):        
         offset += 12    # skip over generic fragment header first
         f = self
-        (f.flags, f.size1, f.fragRef1 ) = struct.unpack('<iii',  buf[offset:offset+12])
-        offset += 12
+        (f.flags, f.size1, f.fragRef1 ) = self.HEADER.unpack_from(buf, offset)
+        offset += self.HEADER.size
         
         f.params1_0 = f.params1_1 = f.params1_2 = f.params1 = 0
+        f.params2 = 0.0
         
         if f.flags & 1:
-            (f.params1_0, f.params1_1, f.params1_2) =  struct.unpack('<iii',  buf[offset:offset+12])
+            (f.params1_0, f.params1_1, f.params1_2) = self.PARAMS1.unpack_from(buf, offset)
             offset += 12
         if f.flags & (1 << 1):
-            (f.params2,) =  struct.unpack('<f',  buf[offset:offset+4])
+            (f.params2,) = self.PARAMS2.unpack_from(buf, offset)
             offset += 4
           
-        f.entries = []
+        # skeleton entries: the fixed fields (nameRef, flags, fragRef1, fragRef2, size) followed by 
+        # size indices. The fixed fields go into entries (a structured array with numpy, a list of 
+        # tuples otherwise), the indices of all entries go into one flat array: entry i's indices are 
+        # entryIndices[entryIndexOffsets[i]:entryIndexOffsets[i+1]] (see getEntryIndices())
+        # we only need to look at the size fields to find where the entries start
+        starts = []
+        entries_offset = offset
         for i in range(0, f.size1):
-            (nameRef, flags, fragRef1, fragref2, size) =  struct.unpack('<iiiii',  buf[offset:offset+20])
-            offset += 20
-            index_list = []
-            for j in range(0, size):
-                (index,) =  struct.unpack('<i',  buf[offset:offset+4])
-                offset += 4
-                index_list.append(index)
-
-            f.entries.append((nameRef, flags, fragRef1, fragref2, size, index_list))
+            starts.append(offset)
+            (size,) = INT.unpack_from(buf, offset+16)
+            offset += self.ENTRY.size + size*4
+            
+        if numpy != None:
+            ints = numpyView(buf, '<i4', entries_offset, (offset-entries_offset)/4)
+            fixed = (numpy.array(starts, numpy.int32) - entries_offset) / 4
+            fixed = fixed[:, numpy.newaxis] + numpy.arange(5)
+            f.entries = numpy.ascontiguousarray(ints[fixed]).view(self.ENTRY_DTYPE).reshape(-1)
+            is_index = numpy.ones(len(ints), numpy.bool_)
+            is_index[fixed] = False
+            f.entryIndices = ints[is_index]
+            f.entryIndexOffsets = numpy.zeros(f.size1+1, numpy.int32)
+            numpy.cumsum(f.entries['size'], out=f.entryIndexOffsets[1:])
+        else:
+            f.entries = []
+            f.entryIndices = array.array('i')
+            f.entryIndexOffsets = [0]
+            for start in starts:
+                entry = self.ENTRY.unpack_from(buf, start)
+                f.entries.append(entry)
+                f.entryIndices.extend(arrayStruct('i', entry[4]).unpack_from(buf, start+self.ENTRY.size))
+                f.entryIndexOffsets.append(len(f.entryIndices))
 
         f.size2 = 0
         if f.flags & (1 << 9):
-            (f.size2,) =  struct.unpack('<i',  buf[offset:offset+4])
+            (f.size2,) = INT.unpack_from(buf, offset)
             offset += 4
-            f.fragRefs3 = []
-            f.data3 = []
-            for i in range(0, f.size2):
-                (ref,) =  struct.unpack('<i',  buf[offset:offset+4])
-                offset += 4
-                f.fragRefs3.append(ref)
-            for i in range(0, f.size2):
-                (data,) =  struct.unpack('<i',  buf[offset:offset+4])
-                offset += 4
-                f.data3.append(ref)
+            if numpy != None:
+                f.fragRefs3 = numpyView(buf, '<i4', offset, f.size2)
+                f.data3 = numpyView(buf, '<i4', offset+f.size2*4, f.size2)
+            else:
+                s = arrayStruct('i', f.size2)
+                f.fragRefs3 = list(s.unpack_from(buf, offset))
+                f.data3 = list(s.unpack_from(buf, offset+s.size))
+            offset += f.size2*8
+            
+    # Returns the indices of skeleton entry i
+    def getEntryIndices(self, i):
+        return self.entryIndices[self.entryIndexOffsets[i]:self.entryIndexOffsets[i+1]]
                 
             
     def dump(self):
@@ -616,23 +1305,25 @@ class Fragment10(Fragment):
             (f.params1_0, f.params1_1, f.params1_2, f.params2)
 
         print 'skeleton entries:%i' % (f.size1)
-        for e in f.entries:
+        for i in range(0, f.size1):
+            e = f.entries[i]
             print '\tnameRef:%i name:%s flags:0x%x fragRef1:%i fragref2:%i size:%i ' % \
                 (e[0], self.wld.getName(e[0]) ,e[1], e[2], e[3], e[4])
-            for i in range(0, e[4]):
-                print '\tindex:%i' % (e[5][i])
+            for index in f.getEntryIndices(i):
+                print '\tindex:%i' % (index)
                     
 
 # Texture Bitmap Info Reference
 class Fragment05(Fragment):
+    HEADER = struct.Struct('<Ii')
+    
     def __init__(self, id, type, nameRef, wld):
         Fragment.__init__(self, id, type, nameRef, wld)
         
     def decode(self, buf, offset):        
         offset += 12    # skip over generic fragment header first
         f = self
-        (f.frag04Ref, f.flags  ) = struct.unpack('<Ii',  buf[offset:offset+8])
-        offset += 8
+        (f.frag04Ref, f.flags  ) = self.HEADER.unpack_from(buf, offset)
         
     def dump(self):
         Fragment.dump(self)
@@ -641,6 +1332,8 @@ class Fragment05(Fragment):
         
 # Texture Bitmap Info
 class Fragment04(Fragment):
+    HEADER = struct.Struct('<ii')
+    
     def __init__(self, id, type, nameRef, wld):
         Fragment.__init__(self, id, type, nameRef, wld)
         self.params1 = 0
@@ -649,23 +1342,19 @@ class Fragment04(Fragment):
     def decode(self, buf, offset):        
         offset += 12    # skip over generic fragment header first
         f = self
-        (f.flags, f.numRefs ) = struct.unpack('<ii',  buf[offset:offset+8])
-        offset += 8
+        (f.flags, f.numRefs ) = self.HEADER.unpack_from(buf, offset)
+        offset += self.HEADER.size
         
         # read optional parameters (according to the flags field)
         if f.flags & (1 << 2):
-            (f.params1, ) = struct.unpack('<i',  buf[offset:offset+4])
+            (f.params1, ) = INT.unpack_from(buf, offset)
             offset += 4
         if f.flags & (1 << 3):
             # currently assuming  this is the time in ms between animation updates
-            (f.params2, ) = struct.unpack('<i',  buf[offset:offset+4])
+            (f.params2, ) = INT.unpack_from(buf, offset)
             offset += 4
 
-        f.frag03Refs = []
-        for i in range(0, f.numRefs):
-            (ref,) = struct.unpack('<I',  buf[offset:offset+4])
-            offset += 4
-            f.frag03Refs.append(ref)
+        f.frag03Refs = list(arrayStruct('I', f.numRefs).unpack_from(buf, offset))
         
     def dump(self):
         Fragment.dump(self)
@@ -685,40 +1374,34 @@ class Fragment04(Fragment):
 
 # Texture Bitmap Names        
 class Fragment03(Fragment):
+    HEADER = struct.Struct('<i')
+    
     def __init__(self, id, type, nameRef, wld):
         Fragment.__init__(self, id, type, nameRef, wld)
         
     def decode(self, buf, offset):        
         offset += 12    # skip over generic fragment header first
         f = self
-        (f.numNames,) = struct.unpack('<i',  buf[offset:offset+4])
-        offset += 4
+        (f.numNames,) = self.HEADER.unpack_from(buf, offset)
+        offset += self.HEADER.size
         if f.numNames == 0:
             f.numNames = 1
             
         # print f.numNames
         f.names = []
         for i in range(0, f.numNames):
-            (namelen,) = struct.unpack('<H',  buf[offset:offset+2])
+            (namelen,) = USHORT.unpack_from(buf, offset)
             offset += 2
             
             if namelen > 0:
-                format = '<'+str(namelen)+'s'
-                # print namelen
-                # print format
-                (namehash,) = struct.unpack(format, buf[offset:offset+namelen])
+                # buf is a memoryview, the slice is copied once into the bytearray we decode in place
+                name = f.wld.decodeBytes(bytearray(buf[offset:offset+namelen]))
                 offset += namelen
-            
-                name = f.wld.decodeBytes(bytearray(namehash))             
                 
                 # strip the C style 0 byte terminator
-                j = 0
-                end = 0
-                for c in name:
-                    if c == 0:
-                        end = j
-                        break;
-                    j += 1
+                end = name.find('\0')
+                if end == -1:
+                    end = 0
                 name = str(name[0:end])
                 f.names.append(name)
             
@@ -729,3 +1412,30 @@ class Fragment03(Fragment):
         for name in f.names:
             print name
 
+
+# ------------------------------------------------------------------------------
+# codec registration: new fragment types only need their class registered here
+# ------------------------------------------------------------------------------
+
+fragment_codecs.register(0x37, Fragment37)
+fragment_codecs.register(0x36, Fragment36)
+fragment_codecs.register(0x31, Fragment31)
+fragment_codecs.register(0x30, Fragment30)
+fragment_codecs.register(0x2F, Fragment2F)
+fragment_codecs.register(0x2D, Fragment2D)
+fragment_codecs.register(0x2A, Fragment2A)
+fragment_codecs.register(0x29, Fragment29)
+fragment_codecs.register(0x28, Fragment28)
+fragment_codecs.register(0x22, Fragment22)
+fragment_codecs.register(0x21, Fragment21)
+fragment_codecs.register(0x1C, Fragment1C)
+fragment_codecs.register(0x1B, Fragment1B)
+fragment_codecs.register(0x15, Fragment15)
+fragment_codecs.register(0x14, Fragment14)
+fragment_codecs.register(0x13, Fragment13)
+fragment_codecs.register(0x12, Fragment12)
+fragment_codecs.register(0x11, Fragment11)
+fragment_codecs.register(0x10, Fragment10)
+fragment_codecs.register(0x05, Fragment05)
+fragment_codecs.register(0x04, Fragment04)
+fragment_codecs.register(0x03, Fragment03)
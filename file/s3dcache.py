@@ -0,0 +1,273 @@
+'''
+s3dcache
+
+on disk cache of inflated s3d file contents for zonewalk
+(c) gsk 2012
+
+
+Copyright (c) 2012, Gedolian Soft Kram
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided
+that the following conditions are met:
+
+    Redistributions of source code must retain the above copyright notice, this list of conditions
+    and the following disclaimer.
+    Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+    and the following disclaimer in the documentation and/or other materials provided with the distribution.
+    Neither the name of the <ORGANIZATION> nor the names of its contributors may be used to endorse or
+    promote products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+-------------------------------------------------------------------------------
+CACHE FILE REFERENCE
+-------------------------------------------------------------------------------
+
+There is one cache file per s3d archive. The cache has a byte budget: when the cache files
+grow beyond it the least recently used ones get deleted (see S3DCache.trim()). Cache files
+of archives that are currently open are never deleted. When even that does not make room
+for a new record, the cache file stops growing.
+
+ It is only valid for the exact archive it was
+created from: the archive path, size and modification time are stored in the header and
+a mismatch on any of these throws the cached data away.
+
+    HEADER
+        MAGIC           [ 4 bytes 'S3DC' ]
+        VERSION         [ u32 ]
+        ARCHIVE_SIZE    [ u64 ]
+        ARCHIVE_MTIME   [ double ]
+        PATH_LEN        [ u32 ]
+        PATH            [ PATH_LEN bytes ]
+    RECORDS             [ appended whenever a file gets inflated from the archive ]
+        DATA_OFFSET     [ u32, the s3d directory data_offset of the file, used as key ]
+        LENGTH          [ u32 ]
+        DATA            [ LENGTH bytes, the inflated file contents ]
+
+The record index is rebuilt by walking the record headers when the cache file is opened.
+
+'''
+
+import os
+import struct
+import mmap
+import zlib
+
+CACHE_MAGIC = 'S3DC'
+CACHE_VERSION = 1
+
+
+class S3DCacheFile():
+
+    HEADER_FORMAT = '<4sIQdI'
+    RECORD_FORMAT = '<II'
+
+    def __init__(self, filename, archive_path, archive_size, archive_mtime, cache=None):
+        self.filename = filename
+        self.cache = cache      # the S3DCache we belong to, it keeps the cache within its budget
+        self.archive_path = archive_path
+        self.archive_size = archive_size
+        self.archive_mtime = archive_mtime
+
+        self.data = None        # mmap of the cache file
+        self.records = {}       # data_offset -> (position, length) of the cached data
+        self.end = 0            # end of the last complete record
+        self.valid = 0
+
+    def header(self):
+        return struct.pack(self.HEADER_FORMAT, CACHE_MAGIC, CACHE_VERSION, self.archive_size, self.archive_mtime,
+            len(self.archive_path)) + self.archive_path
+
+    # open the cache file and build the record index, a stale or broken cache file is reset
+    def open(self):
+        header = self.header()
+        try:
+            if os.path.exists(self.filename) and os.path.getsize(self.filename) >= len(header):
+                cfile = open(self.filename, 'rb')
+                if cfile.read(len(header)) == header:
+                    self.data = mmap.mmap(cfile.fileno(), 0, access=mmap.ACCESS_READ)
+                cfile.close()
+
+            if self.data == None:
+                # no cache yet or the archive has changed since the cache was written
+                cfile = open(self.filename, 'wb')
+                cfile.write(header)
+                cfile.close()
+                self.valid = 1
+                return 0
+        except (EnvironmentError, ValueError) as e:
+            print 'WARNING S3DCacheFile: cannot open cache file %s: %s' % (self.filename, e)
+            self.close()
+            return -1
+
+        # walk the records, anything incomplete at the end (interrupted write) gets cut off
+        offset = len(header)
+        record_size = struct.calcsize(self.RECORD_FORMAT)
+        end = len(self.data)
+        while offset + record_size <= end:
+            (data_offset, length) = struct.unpack_from(self.RECORD_FORMAT, self.data, offset)
+            if offset + record_size + length > end:
+                break
+            self.records[data_offset] = (offset + record_size, length)
+            offset += record_size + length
+
+        self.end = offset
+        if self.end != end:
+            self.truncate()
+
+        self.valid = 1
+        return 0
+
+    def truncate(self):
+        self.close()
+        cfile = open(self.filename, 'r+b')
+        cfile.truncate(self.end)
+        cfile.close()
+        self.records = {}
+        self.open()
+
+    def close(self):
+        if self.data != None:
+            self.data.close()
+        self.data = None
+        self.valid = 0
+
+    # Returns the cached contents of the file stored at data_offset in the archive or None
+    def getMember(self, data_offset):
+        record = self.records.get(data_offset)
+        if record == None:
+            return None
+
+        (position, length) = record
+        return self.data[position:position+length]
+
+    # append the inflated contents of the file stored at data_offset in the archive
+    def addMember(self, data_offset, data):
+        if self.valid == 0 or self.records.has_key(data_offset):
+            return
+
+        record_size = struct.calcsize(self.RECORD_FORMAT) + len(data)
+        if self.cache != None and self.cache.reserve(record_size, self.filename) != 0:
+            return
+
+        try:
+            cfile = open(self.filename, 'ab')
+            cfile.write(struct.pack(self.RECORD_FORMAT, data_offset, len(data)))
+            cfile.write(data)
+            cfile.close()
+        except EnvironmentError as e:
+            print 'WARNING S3DCacheFile: cannot write to cache file %s: %s' % (self.filename, e)
+            self.valid = 0
+            return
+
+        # these are not in our mmap, the caller has the data in memory anyway
+        self.records[data_offset] = None
+
+
+class S3DCache():
+
+    # budget is the maximum size of all cache files together in bytes
+    def __init__(self, cache_dir, budget):
+        self.cache_dir = cache_dir
+        self.budget = budget
+        self.usage = None       # bytes used by the cache files, None until trim() has looked
+        self.open_files = {}    # cache file name -> number of S3DFiles using it, trim() leaves these alone
+
+    # Returns a list of (mtime, size, path) of all cache files
+    def listCacheFiles(self):
+        files = []
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return files
+
+        for name in names:
+            if not name.endswith('.s3c'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+        return files
+
+    # delete the least recently used cache files until the cache plus the needed bytes fit
+    # into the budget, the file keep and the files of open archives are left alone
+    # files that can't be deleted (still mapped on windows) are skipped
+    def trim(self, needed=0, keep=None):
+        files = self.listCacheFiles()
+        self.usage = 0
+        for (mtime, size, path) in files:
+            self.usage += size
+
+        files.sort()
+        for (mtime, size, path) in files:
+            if self.usage + needed <= self.budget:
+                break
+            if path == keep or self.open_files.has_key(path):
+                continue
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self.usage -= size
+
+    # account for bytes about to be appended to the cache file filename, making room if necessary
+    # Returns 0 if they fit into the budget, -1 otherwise
+    def reserve(self, size, filename):
+        if self.usage == None or self.usage + size > self.budget:
+            self.trim(size, filename)
+            if self.usage + size > self.budget:
+                return -1
+
+        self.usage += size
+        return 0
+
+    # open the cache file for an s3d archive
+    # Returns an S3DCacheFile or None if the cache is not usable
+    def openArchive(self, archive_path):
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            st = os.stat(archive_path)
+        except EnvironmentError as e:
+            print 'WARNING S3DCache: cache disabled for %s: %s' % (archive_path, e)
+            return None
+
+        # cache files are named after the archive plus a hash of its full path so that archives
+        # with the same name from different EQ directories don't collide
+        path = os.path.abspath(archive_path)
+        name = '%s_%08x.s3c' % (os.path.basename(path), zlib.crc32(path) & 0xffffffff)
+        filename = os.path.join(self.cache_dir, name)
+        cache_file = S3DCacheFile(filename, path, st.st_size, st.st_mtime, self)
+        if cache_file.open() != 0:
+            return None
+        self.open_files[filename] = self.open_files.get(filename, 0) + 1
+
+        # the file's mtime marks when it was last used, trim() deletes the oldest first
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        self.trim(0, filename)
+
+        return cache_file
+
+    # close a cache file returned by openArchive(), trim() may delete it from now on
+    def closeArchive(self, cache_file):
+        cache_file.close()
+        count = self.open_files.get(cache_file.filename, 0) - 1
+        if count > 0:
+            self.open_files[cache_file.filename] = count
+        else:
+            self.open_files.pop(cache_file.filename, None)
@@ -30,10 +30,48 @@ OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMA
 
 '''
 
+import os
 import sys
+import time
 import struct
 import zlib
+import mmap
+import hashlib
 from operator import attrgetter
+from bisect import bisect_left
+from multiprocessing import Pool, cpu_count
+from multiprocessing.pool import ThreadPool
+
+# thread pools used for parallel block inflation, keyed by number of worker threads
+# these are shared between all S3DFile objects
+inflate_pools = {}
+
+def getInflatePool(threads):
+    if not inflate_pools.has_key(threads):
+        inflate_pools[threads] = ThreadPool(threads)
+    return inflate_pools[threads]
+
+# the directory entry of the file name listing always carries this crc
+FILENAME_LISTING_CRC = 0x61580AC9
+
+# lookup table for the filename crcs stored in the s3d directory: IEEE 802.3 polynomial 0x04C11DB7
+# processed MSB first, starting from 0 (this is NOT the reflected variant zlib.crc32 implements)
+crc_table = []
+for i in range(0, 256):
+    crc = i << 24
+    for j in range(0, 8):
+        if crc & 0x80000000:
+            crc = ((crc << 1) ^ 0x04C11DB7) & 0xffffffff
+        else:
+            crc = (crc << 1) & 0xffffffff
+    crc_table.append(crc)
+    
+# calculate the directory crc for a file name: the crc covers the lower case name including its C style 0 terminator
+def filenameCRC(name):
+    crc = 0
+    for c in name.lower()+'\0':
+        crc = ((crc << 8) & 0xffffffff) ^ crc_table[((crc >> 24) ^ ord(c)) & 0xff]
+    return crc
 
 class S3DDirEntry():
     
@@ -44,9 +82,11 @@ class S3DDirEntry():
         self.crc = 0                          # u32 filename CRC calculated using the IEEE 802.3 Ethernet CRC-32 algorithm 
         self.data_offset = 0               # u32 offset into the compressed data loaded from the s3d file
         self.data_length_inflated = 0   # u32 length of data once inflated
+        
+        self.entry = None                  # the S3DFileEntry created for us
 
     def unpack(self, data, start):
-        (self.crc, self.data_offset, self.data_length_inflated) = struct.unpack('<III', data[start:start+self.SIZE])
+        (self.crc, self.data_offset, self.data_length_inflated) = struct.unpack_from('<III', data, start)
         
         
 class S3DFileEntry():
@@ -55,17 +95,47 @@ class S3DFileEntry():
         self.filename = None
         self.size = 0
         self.data = ''
+        self.dir = None         # the S3DDirEntry describing where our data blocks live in the s3d file
+        self.loaded = 0         # set to 1 once the data blocks have been inflated into data
         
         
 class S3DFile():
 
-    def __init__(self, filename):
+    # Params
+    # filename is the full path of the s3d file without the .s3d extension
+    # lazy = 1 only inflates the file listing during load(), all other files are inflated 
+    # the first time they are requested through getFile()
+    # use_mmap = 1 memory maps the s3d file instead of reading it into one big string
+    # threads > 1 inflates the data blocks on a pool of that many worker threads
+    # listing = 0 does not inflate the file name listing in lazy mode: getFile() then finds files through 
+    # the crc of their name (the listing still gets loaded on demand if a name can't be resolved that way)
+    # verify_crc = 1 checks the names in the listing against the crcs in the directory
+    # cache is an optional S3DCache object: inflated files are then served from/stored into its on disk cache
+    def __init__(self, filename, lazy=0, use_mmap=1, threads=0, listing=1, verify_crc=0, cache=None):
         self.name = filename
+        self.lazy = lazy
+        self.use_mmap = use_mmap
+        self.threads = threads
+        self.listing = listing
+        self.verify_crc = verify_crc
+        self.cache = cache
+        self.cache_file = None  # our S3DCacheFile if we have a cache
+        self.s3d_data = None    # raw s3d file contents (string or mmap), kept around in lazy mode for later inflates
         self.direntries = []
         self.fileentries = []
         self.files_by_name = {}
         
-    def load(self):
+        self.crcs = []              # directory crcs in ascending order (as stored in the s3d file) for bisect lookups
+        self.entries_by_crc = []    # the file entries in the same order
+        self.file_listing_entry = None
+        self.listing_loaded = 0
+        self.listing_count = 0  # number of names in the file listing, see loadListing()
+        self.quiet = 0
+        
+    # quiet suppresses the progress and warning output (errors are still printed), for
+    # callers going through many archives at once like the catalog scan
+    def load(self, quiet=0):
+        self.quiet = quiet
         s3dfile_name = self.name+'.s3d'
         # print 'loading zone s3dfile: ' + s3dfile_name
         
@@ -75,21 +145,50 @@ class S3DFile():
         except:
             return -1
             
-        s3d_data = s3dfile.read()
+        # with the file mapped into memory the OS only pages in those parts of the archive we
+        # actually touch, the directory and block headers are read in place using unpack_from()
+        # and the compressed block data is handed to zlib through buffer() slices so nothing gets copied
+        s3d_data = None
+        if self.use_mmap == 1:
+            try:
+                s3d_data = mmap.mmap(s3dfile.fileno(), 0, access=mmap.ACCESS_READ)
+            except (EnvironmentError, ValueError):
+                s3d_data = None     # can't map this one (empty file etc.), fall back to reading it
+                
+        if s3d_data == None:
+            s3d_data = s3dfile.read()
         s3dfile.close()
+        self.s3d_data = s3d_data
+        
+        # the cache is only valid for this exact archive (path, size and mtime), the cache
+        # takes care of resetting itself if it's stale so we'll just inflate everything again then
+        if self.cache != None:
+            self.cache_file = self.cache.openArchive(self.name+'.s3d')
         
         # S3D HEADER
         # extract header data: 12 bytes containing 
         # u32 diroffset 
         # 4 bytes string magic cookie
         # u32 unknown_always_131072
-        (diroffset, cookie, unknown) = struct.unpack('<I4sI', s3d_data[0:12])
+        if len(s3d_data) < 12:
+            print 'ERROR S3DFile:%s file too short for an s3d header' % (self.name)
+            self.close()
+            return -1
+        (diroffset, cookie, unknown) = struct.unpack_from('<I4sI', s3d_data, 0)
         # print 'directory offset:', str(diroffset), ' magic:', cookie, ' unknown_131072: ', str(unknown)
+        if cookie != 'PFS ' or diroffset+4 > len(s3d_data):
+            print 'ERROR S3DFile:%s not an s3d file or truncated (magic:%r directory offset:%i)' % (self.name, cookie, diroffset)
+            self.close()
+            return -1
 
         # S3D Directory Entries
         # get number of directory entries: stored as a 32 bit int at diroffset
-        (num_direntries,) = struct.unpack('<i', s3d_data[diroffset:diroffset+4])
+        (num_direntries,) = struct.unpack_from('<i', s3d_data, diroffset)
         # print 'number of directory entries in the s3d file:', str(num_direntries), ', loading ...'
+        if num_direntries <= 0 or diroffset+4+num_direntries*12 > len(s3d_data):
+            print 'ERROR S3DFile:%s invalid directory: %i entries at offset %i' % (self.name, num_direntries, diroffset)
+            self.close()
+            return -1
         
         # load all directory entries: these are sorted by the filename crc
         diroffset += 4
@@ -102,56 +201,89 @@ class S3DFile():
             diroffset += dir.SIZE
                 
         # change sort key to data_offset so that this matches the file names listing and then store
+        # the crc sort order is kept as well (re-sorted to be on the safe side) for the crc lookups 
         self.direntries = sorted(dirent, key=attrgetter('data_offset'))
+        dirent_by_crc = sorted(dirent, key=attrgetter('crc'))
         
-        # now assemble the files from data blocks we loaded from the s3d file
-        high_offset = 0
-        file_listing_entry = None
-        
+        # create the file entries: the data blocks are inflated further below unless we're in lazy mode
         for dir in self.direntries:
             # print 'processing direentry with crc=', dir.crc
             
             entry = S3DFileEntry()
+            entry.dir = dir
+            entry.size = dir.data_length_inflated
+            dir.entry = entry
             self.fileentries.append(entry)
             
-            # read the data blocks for this directory entry: each block consists of a block header followed by the compressed block data
-            offset = dir.data_offset
-
+        self.crcs = [dir.crc for dir in dirent_by_crc]
+        self.entries_by_crc = [dir.entry for dir in dirent_by_crc]
+        
+        high_offset = 0
+        file_listing_entry = None
+        
+        for entry in self.fileentries:
+            dir = entry.dir
+            
             # we need to remember the highest offset we encounter because the last directory object in the file is the file name listing
             # which we'll need a bit further below
-            if (offset > high_offset): 
-                high_offset = offset   
+            if (dir.data_offset > high_offset): 
+                high_offset = dir.data_offset   
                 file_listing_entry = entry
                 
-            inflated_length_read = 0
-            n_blocks = 0
-            while inflated_length_read < dir.data_length_inflated:
-                # S3D BLOCK HEADER: get block header data
-                (deflated_length, inflated_length) = struct.unpack('<ii', s3d_data[offset:offset+8])
-                offset += 8
-                # print 'block', str(n_blocks), ' deflated_length=', str(deflated_length), ' inflated_length=', str(inflated_length)
-
-                # get the block data and inflate: note that we actually just extract a string variable containing the original binary and still z compressed data here
-                # in order to actually use them,  these need to be a.) decompressed and b.) unmarshalled (using struct.unpack) in case of numbers
-                # see the treatment of the filename lengths inside the filename listing code further below
-                format = '<'+str(deflated_length)+'s'
-                (blockdata,) = struct.unpack(format, s3d_data[offset:offset+deflated_length])
-                entry.data = entry.data+zlib.decompress(blockdata)   # decompress & store
+        # repacked archives (see repack() below) store the listing up front: the listing crc is the reliable way to find it
+        entries = self.findEntriesByCRC(FILENAME_LISTING_CRC)
+        if len(entries) == 1:
+            file_listing_entry = entries[0]
+            
+        self.file_listing_entry = file_listing_entry
+        
+        # inflate everything in one go so that the blocks of all files can be spread over the thread pool
+        if self.lazy == 0:
+            if self.inflateEntries(self.fileentries) != 0:
+                self.close()
+                return -1
                 
-                offset += deflated_length
-                inflated_length_read += inflated_length
-                entry.size += inflated_length
-                n_blocks += 1
+        if self.lazy == 0 or self.listing == 1 or self.verify_crc == 1:
+            if self.loadListing() != 0:
+                self.close()
+                return -1
                 
-        # load the file listing which is contained in the entry with the highest offset (at the end of the disk file)
-        # We have stored this last file entry into file_listing_entry in the decompress loop above
-        # the listing itself. as it appears in the S3D file, is sorted by data_offset of the underlying files
+        if self.verify_crc == 1:
+            for name in self.verifyCRCs():
+                if self.quiet == 0:
+                    print 'WARNING S3DFile:%s crc mismatch for file:%s' % (self.name, name)
+            
+        # the raw data is only needed for inflating files later on
+        if self.lazy == 0:
+            self.close()
+            
+        if self.quiet == 0:
+            print 'S3DFile load complete.'
+        # self.dump_listing()       
+        return 0
+        
+    # load the file listing which is contained in the entry with the highest offset (at the end of the disk file)
+    # We have stored this last file entry into file_listing_entry in load()
+    # the listing itself. as it appears in the S3D file, is sorted by data_offset of the underlying files
+    # (the listing's own entry is not part of it, wherever it is stored)
+    def loadListing(self):
+        file_listing_entry = self.file_listing_entry
+        if file_listing_entry.loaded == 0:
+            if self.inflateEntry(file_listing_entry) != 0:
+                return -1
+            
         data = file_listing_entry.data
         (n_filenames,) = struct.unpack('<i', data[0:4])
         # print 'number of file names in file listing:', str(n_filenames), ', loading ...'
         
+        self.listing_count = n_filenames
+        fileentries = [entry for entry in self.fileentries if entry != file_listing_entry]
+        if n_filenames != len(fileentries) and self.quiet == 0:
+            # only the verifier treats this as an error, we name what we can
+            print 'WARNING S3DFile:%s file listing holds %i names for %i files' % (self.name, n_filenames, len(fileentries))
+        
         offset = 4
-        for i in range(0, n_filenames):
+        for i in range(0, min(n_filenames, len(fileentries))):
             # each entry here is a u32 length field followed by the filename string (including a superfluous C style NULL terminator)
             (name_len,) = struct.unpack('<i', data[offset:offset+4])
             offset += 4
@@ -161,38 +293,410 @@ class S3DFile():
             (filename,) = struct.unpack(format, data[offset:offset+name_len-1])     # strip the \0 terminator
             offset += name_len
 
-            self.fileentries[i].filename = filename
-            self.files_by_name[filename] = self.fileentries[i]      # insert into filename keyed directory for easy retrieval
+            fileentries[i].filename = filename
+            self.files_by_name[filename] = fileentries[i]      # insert into filename keyed directory for easy retrieval
             
-            # print 'filename:', filename, ' for file with size:', self.fileentries[i].size
+            # print 'filename:', filename, ' for file with size:', fileentries[i].size
             
-        print 'S3DFile load complete.'
-        # self.dump_listing()       
+        self.listing_loaded = 1
+        return 0
+        
+    # check the names from the file listing against the crcs stored in the directory 
+    # Returns a list of the file names that don't match
+    def verifyCRCs(self):
+        mismatches = []
+        for entry in self.fileentries:
+            if entry.filename != None and filenameCRC(entry.filename) != entry.dir.crc:
+                mismatches.append(entry.filename)
+                
+        return mismatches
+        
+    # find a file entry by the directory crc of its name using a binary search over the crc sorted directory
+    # Returns a list of the matching entries (usually one, more if there are crc collisions)
+    def findEntriesByCRC(self, crc):
+        entries = []
+        i = bisect_left(self.crcs, crc)
+        while i < len(self.crcs) and self.crcs[i] == crc:
+            entries.append(self.entries_by_crc[i])
+            i += 1
+            
+        return entries
+        
+    # walk the block headers of a file without inflating anything: each block consists of a block header
+    # followed by the compressed block data
+    # Returns a list of (offset, deflated_length, inflated_length) tuples, one per block, or None if the
+    # headers don't add up to the inflated length stored in the directory
+    def scanBlocks(self, dir):
+        s3d_data = self.s3d_data
+        offset = dir.data_offset
+        
+        blocks = []
+        inflated_length_read = 0
+        while inflated_length_read < dir.data_length_inflated:
+            # S3D BLOCK HEADER: get block header data
+            (deflated_length, inflated_length) = struct.unpack_from('<ii', s3d_data, offset)
+            offset += 8
+            # print 'block', str(len(blocks)), ' deflated_length=', str(deflated_length), ' inflated_length=', str(inflated_length)
+            
+            if deflated_length <= 0 or inflated_length <= 0 or offset+deflated_length > len(s3d_data):
+                print 'ERROR S3DFile:%s invalid block header at offset %i: deflated_length=%i inflated_length=%i' % \
+                    (self.name, offset-8, deflated_length, inflated_length)
+                return None
+                
+            blocks.append((offset, deflated_length, inflated_length))
+            offset += deflated_length
+            inflated_length_read += inflated_length
+            
+        if inflated_length_read != dir.data_length_inflated:
+            print 'ERROR S3DFile:%s block headers at offset %i add up to %i bytes, directory says %i' % \
+                (self.name, dir.data_offset, inflated_length_read, dir.data_length_inflated)
+            return None
+            
+        return blocks
+        
+    # get the block data and inflate: buffer() gives zlib a view on the compressed data without copying it
+    # (memoryview would be the obvious choice but Python 2's zlib only takes strings and old style buffers)
+    # zlib releases the GIL while inflating so this can run on several threads at once
+    def inflateBlock(self, block):
+        return zlib.decompress(buffer(self.s3d_data, block[0], block[1]))
+        
+    # put a file together from its inflated blocks
+    # join() sizes the result up front and copies every block into it once (growing a string
+    # block by block is quadratic), a single block file is used as is
+    def assembleEntry(self, entry, blocks, inflated_blocks):
+        for i in range(0, len(blocks)):
+            block = inflated_blocks[i]
+            
+            # verify the block against its header before storing it
+            if len(block) != blocks[i][2]:
+                print 'ERROR S3DFile:%s block %i at offset %i: inflated to %i bytes, header says %i' % \
+                    (self.name, i, blocks[i][0]-8, len(block), blocks[i][2])
+                return -1
+                
+        # everything downstream (texture loaders, DDS patching etc.) works on plain strings
+        entry.data = ''.join(inflated_blocks)
+        entry.loaded = 1
         return 0
+        
+    # inflate the data blocks for a number of file entries
+    # all block headers are scanned first, the blocks are then inflated (on our thread pool if we have one) 
+    # and finally stitched back together in order
+    # Returns 0 on success, -1 if the block data does not add up to the inflated lengths from the directory
+    def inflateEntries(self, entries):
+        # serve whatever we can from the cache
+        if self.cache_file != None:
+            remaining = []
+            for entry in entries:
+                data = self.cache_file.getMember(entry.dir.data_offset)
+                if data != None and len(data) == entry.dir.data_length_inflated:
+                    entry.data = data
+                    entry.loaded = 1
+                else:
+                    remaining.append(entry)
+            entries = remaining
+            
+        all_blocks = []
+        spans = []
+        for entry in entries:
+            blocks = self.scanBlocks(entry.dir)
+            if blocks == None:
+                return -1
+            spans.append((entry, len(all_blocks), len(blocks)))
+            all_blocks.extend(blocks)
             
+        if self.threads > 1 and len(all_blocks) > 1:
+            pool = getInflatePool(self.threads)
+            inflated_blocks = pool.map(self.inflateBlock, all_blocks, max(1, len(all_blocks) / (self.threads*4)))
+        else:
+            inflated_blocks = map(self.inflateBlock, all_blocks)
+            
+        for (entry, start, n_blocks) in spans:
+            if self.assembleEntry(entry, all_blocks[start:start+n_blocks], inflated_blocks[start:start+n_blocks]) != 0:
+                return -1
+            if self.cache_file != None:
+                self.cache_file.addMember(entry.dir.data_offset, entry.data)
+                
+        return 0
+        
+    def inflateEntry(self, entry):
+        return self.inflateEntries([entry])
+        
+    # Returns the number of bytes of inflated file data we're holding on to
+    def memoryUsage(self):
+        usage = 0
+        for entry in self.fileentries:
+            if entry.loaded == 1:
+                usage += len(entry.data)
+        return usage
+            
+    # release the raw archive data (unmaps the file if it was memory mapped)
+    # files that have not been inflated yet can't be accessed anymore after this
+    def close(self):
+        if isinstance(self.s3d_data, mmap.mmap):
+            self.s3d_data.close()
+        self.s3d_data = None
+        
+        if self.cache_file != None:
+            self.cache.closeArchive(self.cache_file)
+            self.cache_file = None
+        
+    # returns the file entry for the named file, inflating its data first if that has not happened yet
+    # Without the file listing the name is resolved through its crc, this way nothing but the 
+    # requested file needs to be inflated
     def getFile(self, name):
-        try:
-            file = self.files_by_name[name.lower()]
-            return file
-        except:
+        name = name.lower()
+        file = None
+        if self.files_by_name.has_key(name):
+            file = self.files_by_name[name]
+        elif self.listing_loaded == 0:
+            entries = self.findEntriesByCRC(filenameCRC(name))
+            if len(entries) == 1:
+                file = entries[0]
+                file.filename = name
+                self.files_by_name[name] = file
+            elif self.s3d_data != None and self.loadListing() == 0:
+                # not found or crc collision: we need the real names from the listing to sort this out
+                return self.getFile(name)
+                
+        if file == None:
             return None
+            
+        if file.loaded == 0:
+            if self.s3d_data == None:
+                return None     # we've been closed, no way to inflate this anymore
+            if self.inflateEntry(file) != 0:
+                return None
+            
+        return file
         
     def dumpListing(self):
         n_entries = len(self.fileentries)
         for i in range(0, n_entries):
             f = self.fileentries[i]
             d = self.direntries[i]
-            print 'file:', f.filename,  ' size:', f.size
+            print 'file:', f.filename,  ' size:', f.size, ' crc:0x%x' % (d.crc)
    
 # ------------------------------------------------------------------------------
-# main
+# can use this module standalone as an s3d directory dump, repack and verify tool
+# ------------------------------------------------------------------------------
+
+
+
+# ------------------------------------------------------------------------------
+# repack
 #
-# can use this module standalone as an s3d directory dump tool
+# rewrites an s3d archive so that it opens as fast as possible with S3DFile:
+#   - the file name listing goes right behind the header instead of to the end of the file
+#   - files with identical contents are stored once, their directory entries share the data
+#   - block size and compression level are configurable (larger blocks mean fewer block headers
+#     and zlib calls per file)
+#   - files that don't compress anyway (DDS textures are already compressed) are stored raw,
+#     using zlib level 0 "stored" blocks so that every reader can still handle them
+# The directory crcs are taken over from the original archive as they are.
 # ------------------------------------------------------------------------------
 
+REPACK_STORE_RAW = ('.dds',)
+
+def deflateFile(data, block_size, level):
+    blocks = []
+    for offset in range(0, len(data), block_size):
+        block = data[offset:offset+block_size]
+        deflated = zlib.compress(block, level)
+        blocks.append(struct.pack('<ii', len(deflated), len(block)))
+        blocks.append(deflated)
+        
+    return ''.join(blocks)
+    
+# src_name is the source archive without the .s3d extension (as for S3DFile), dst_filename the full output file name
+# Returns 0 on success, -1 if the source archive could not be loaded
+def repack(src_name, dst_filename, block_size=65536, level=9, store_raw=REPACK_STORE_RAW):
+    src = S3DFile(src_name)
+    if src.load() != 0:
+        return -1
+        
+    # the listing needs to be in the order of the data offsets of the files and duplicates 
+    # share an offset, so we need to know the final layout before we can write anything:
+    # assign offsets relative to the start of the file data first
+    files = [entry for entry in src.fileentries if entry != src.file_listing_entry]
+    data_by_digest = {}     # (md5 digest, length) of the file contents -> index into file_data
+    file_data = []          # unique deflated file contents in output order
+    layout = []             # (relative offset, crc, entry) for every file
+    relative_offset = 0
+    for entry in files:
+        key = (hashlib.md5(entry.data).digest(), len(entry.data))
+        if not data_by_digest.has_key(key):
+            file_level = level
+            if entry.filename != None and entry.filename.endswith(store_raw):
+                file_level = 0
+            deflated = deflateFile(entry.data, block_size, file_level)
+            data_by_digest[key] = (relative_offset, len(file_data))
+            file_data.append(deflated)
+            relative_offset += len(deflated)
+        layout.append((data_by_digest[key][0], entry.dir.crc, entry))
+        
+    # the readers sort the crc ordered directory by data offset, so files sharing an offset end 
+    # up in crc order: the listing has to match that
+    layout.sort()
+    
+    listing = [struct.pack('<i', len(layout))]
+    for (rel_offset, crc, entry) in layout:
+        listing.append(struct.pack('<i', len(entry.filename)+1))
+        listing.append(entry.filename+'\0')
+    listing = ''.join(listing)
+    deflated_listing = deflateFile(listing, block_size, level)
+    
+    # assemble the archive: header, listing, file data, directory
+    data_start = 12 + len(deflated_listing)
+    directory = [(FILENAME_LISTING_CRC, 12, len(listing))]
+    for (rel_offset, crc, entry) in layout:
+        directory.append((crc, data_start + rel_offset, len(entry.data)))
+    directory.sort()
+    
+    diroffset = data_start + relative_offset
+    out = open(dst_filename, 'wb')
+    out.write(struct.pack('<I4sI', diroffset, 'PFS ', 131072))
+    out.write(deflated_listing)
+    for deflated in file_data:
+        out.write(deflated)
+    out.write(struct.pack('<i', len(directory)))
+    for dir in directory:
+        out.write(struct.pack('<III', dir[0], dir[1], dir[2]))
+    out.close()
+    
+    print 'repacked %s.s3d into %s: %i files, %i unique, %i bytes' % \
+        (src_name, dst_filename, len(layout), len(file_data), diroffset+4+len(directory)*12)
+    return 0
+    
+    
+# ------------------------------------------------------------------------------
+# verify
+#
+# checks every file in an archive: block headers, inflated lengths against the directory,
+# the file listing and the filename crcs. Whole directories are spread over a process pool, 
+# each worker streams through its archive one file at a time so memory use stays flat.
+# ------------------------------------------------------------------------------
 
+# verify a single archive, this runs in the pool worker processes
+# Returns (filename, archive size, inflated size, number of files, list of error messages)
+def verifyArchive(filename):
+    errors = []
+    inflated_size = 0
+    n_files = 0
+    try:
+        size = os.path.getsize(filename)
+    except EnvironmentError as e:
+        return (filename, 0, 0, 0, [str(e)])
+        
+    s3d = S3DFile(os.path.splitext(filename)[0], lazy=1, listing=0)
+    try:
+        if s3d.load(quiet=1) != 0:
+            errors.append('invalid header or directory')
+        else:
+            for entry in s3d.fileentries:
+                try:
+                    result = s3d.inflateEntry(entry)
+                except zlib.error as e:
+                    errors.append('file at offset %i: corrupt block data: %s' % (entry.dir.data_offset, e))
+                    continue
+                if result != 0:
+                    errors.append('file at offset %i does not inflate to its directory length %i' % \
+                        (entry.dir.data_offset, entry.dir.data_length_inflated))
+                    continue
+                    
+                n_files += 1
+                inflated_size += entry.size
+                if entry != s3d.file_listing_entry:
+                    entry.data = ''     # done with this one
+                    entry.loaded = 0
+                    
+            n_listed = len([entry for entry in s3d.fileentries if entry != s3d.file_listing_entry])
+            if s3d.file_listing_entry.loaded == 0 or s3d.loadListing() != 0:
+                errors.append('invalid file name listing')
+            elif s3d.listing_count != n_listed:
+                errors.append('file listing holds %i names for %i files' % (s3d.listing_count, n_listed))
+            else:
+                for name in s3d.verifyCRCs():
+                    errors.append('crc mismatch for file %s' % (name))
+    except (struct.error, zlib.error, IndexError, ValueError, EnvironmentError) as e:
+        errors.append('%s: %s' % (e.__class__.__name__, e))
+        
+    s3d.close()
+    return (filename, size, inflated_size, n_files, errors)
+    
+# verify a single archive or all archives in a directory using a pool of processes (0: one per cpu)
+# Returns the number of bad archives
+def verify(path, processes=0):
+    if os.path.isdir(path):
+        filenames = [os.path.join(path, name) for name in sorted(os.listdir(path)) if name.lower().endswith('.s3d')]
+    else:
+        filenames = [path]
+        
+    if processes <= 0:
+        processes = cpu_count()
+        
+    start = time.time()
+    total_size = 0
+    total_inflated = 0
+    bad = 0
+    pool = Pool(min(processes, max(1, len(filenames))))
+    for (filename, size, inflated_size, n_files, errors) in pool.imap_unordered(verifyArchive, filenames):
+        total_size += size
+        total_inflated += inflated_size
+        if len(errors) == 0:
+            print 'OK   %s: %i files, %i bytes' % (filename, n_files, inflated_size)
+        else:
+            bad += 1
+            print 'BAD  %s:' % (filename)
+            for error in errors:
+                print '       ', error
+    pool.close()
+    pool.join()
+    
+    elapsed = max(time.time() - start, 0.001)
+    print '%i archives verified, %i bad: %.1f MB read at %.1f MB/s, %.1f MB inflated at %.1f MB/s (%i processes, %.2fs)' % \
+        (len(filenames), bad, total_size/1048576.0, total_size/1048576.0/elapsed, 
+        total_inflated/1048576.0, total_inflated/1048576.0/elapsed, processes, elapsed)
+    return bad
+    
+    
+# ------------------------------------------------------------------------------
+# main
+# ------------------------------------------------------------------------------
 
+def usage():
+    print 'usage: s3dfile.py <archive without .s3d>                                 dump the archive directory'
+    print '       s3dfile.py repack <archive without .s3d> <output file> [block size] [level]'
+    print '       s3dfile.py verify <archive or directory> [processes]'
+    
 def main():
+    if len(sys.argv) < 2:
+        usage()
+        return
+        
+    if sys.argv[1] == 'repack':
+        if len(sys.argv) < 4:
+            usage()
+            return
+        block_size = 65536
+        level = 9
+        if len(sys.argv) > 4:
+            block_size = int(sys.argv[4])
+        if len(sys.argv) > 5:
+            level = int(sys.argv[5])
+        repack(sys.argv[2], sys.argv[3], block_size, level)
+        return
+        
+    if sys.argv[1] == 'verify':
+        if len(sys.argv) < 3:
+            usage()
+            return
+        processes = 0
+        if len(sys.argv) > 3:
+            processes = int(sys.argv[3])
+        if verify(sys.argv[2], processes) != 0:
+            sys.exit(1)
+        return
+        
     fname = sys.argv[1]
     print 'loading', fname
     f = S3DFile(fname)
@@ -0,0 +1,133 @@
+'''
+s3dpool
+
+pool of loaded s3d archives shared across zone loads for zonewalk
+(c) gsk 2012
+
+
+Copyright (c) 2012, Gedolian Soft Kram
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided
+that the following conditions are met:
+
+    Redistributions of source code must retain the above copyright notice, this list of conditions
+    and the following disclaimer.
+    Redistributions in binary form must reproduce the above copyright notice, this list of conditions
+    and the following disclaimer in the documentation and/or other materials provided with the distribution.
+    Neither the name of the <ORGANIZATION> nor the names of its contributors may be used to endorse or
+    promote products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR
+IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY,
+OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY,
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+The pool keeps the S3DFile objects of recently used archives around (together with
+everything that has been inflated from them so far) so that switching back and forth
+between zones does not parse and inflate the same archives again.
+
+The memory budget covers the inflated file contents held by the pooled archives. When it
+is exceeded the least recently used archives are dropped from the pool. Dropped archives
+get closed to release their file handles. The archives of the zone currently being used
+are pinned: these never get dropped, see Zone.loadS3DFile(). The pool only gets trimmed
+once a zone has finished loading, so the budget may be exceeded while a zone loads.
+
+'''
+
+import os
+from collections import OrderedDict
+
+from s3dfile import S3DFile
+
+
+class S3DPool():
+
+    # budget is the memory budget in bytes, the other params are passed on to the S3DFile objects
+    def __init__(self, budget, threads=0, cache=None):
+        self.budget = budget
+        self.threads = threads
+        self.cache = cache
+
+        self.archives = OrderedDict()   # full archive path (without .s3d) -> (S3DFile, size, mtime), oldest first
+        self.pinned = set()             # archives in use by the current zone, trim() leaves these alone
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    # Returns the S3DFile for the archive (full path without the .s3d extension) or None if it can't be loaded
+    # The archive gets loaded in lazy mode and without its file listing, see Zone.loadS3DFile()
+    def getArchive(self, name):
+        try:
+            st = os.stat(name+'.s3d')
+        except OSError:
+            return None
+
+        record = self.archives.pop(name, None)
+        if record != None and record[1] == st.st_size and record[2] == st.st_mtime:
+            self.hits += 1
+            self.archives[name] = record    # move to the most recently used end
+            return record[0]
+            
+        if record != None:
+            record[0].close()       # the archive changed on disk, the old one is of no use anymore
+
+        # not pooled yet or the archive changed on disk since we loaded it
+        self.misses += 1
+        s3d = S3DFile(name, lazy=1, threads=self.threads, listing=0, cache=self.cache)
+        if s3d.load() != 0:
+            return None
+
+        self.archives[name] = (s3d, st.st_size, st.st_mtime)
+        return s3d
+
+    # pinned archives are never dropped from the pool
+    def pin(self, name):
+        self.pinned.add(name)
+
+    def unpinAll(self):
+        self.pinned.clear()
+
+    # Returns the number of bytes of inflated file data held by the pooled archives
+    def memoryUsage(self):
+        usage = 0
+        for record in self.archives.values():
+            usage += record[0].memoryUsage()
+        return usage
+
+    # drop least recently used archives until we're within budget
+    # pinned archives and the most recently used archive always stay
+    def trim(self):
+        usage = self.memoryUsage()
+        for name in self.archives.keys()[:-1]:
+            if usage <= self.budget:
+                break
+            if name in self.pinned:
+                continue
+            record = self.archives.pop(name)
+            usage -= record[0].memoryUsage()
+            record[0].close()
+            self.evictions += 1
+
+    def clear(self):
+        for record in self.archives.values():
+            record[0].close()
+        self.archives.clear()
+        self.pinned.clear()
+
+    # Returns a dict with the pool statistics
+    def getStats(self):
+        return { 'archives' : len(self.archives), 'memory' : self.memoryUsage(), 'budget' : self.budget,
+                 'hits' : self.hits, 'misses' : self.misses, 'evictions' : self.evictions }
+
+    def statsText(self):
+        stats = self.getStats()
+        return 'archive pool: %i archives, %.1f of %.1f MB, %i hits, %i misses, %i evictions' % \
+            (stats['archives'], stats['memory']/1048576.0, stats['budget']/1048576.0, stats['hits'], stats['misses'],
+            stats['evictions'])
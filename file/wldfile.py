@@ -74,8 +74,76 @@ Version1WLD = 0x00015500
 Version2WLD = 0x1000C800
 MagicWLD =  0x54503D02
 
+# xor codes for the simple hash encoder
+NAMEHASH_CODES = [0x95, 0x3A, 0xC5, 0x2A, 0x95, 0x7A, 0x95, 0x6A]
+
+# one translation table per position in the 8 byte code cycle: decoding then takes 8 strided
+# translate() calls instead of a python level xor per byte
+namehash_tables = [''.join([chr(i ^ code) for i in range(0, 256)]) for code in NAMEHASH_CODES]
+
 from fragment import *
 
+
+# texture file names as stored in the 0x03 fragments are turned into the names we load textures by
+# NOTE
+# in VERSION 2 WLD zones (ex. povalor, postorms) I've found texture names
+# that have three parameters prepended like this for example: 1, 4, 0, POVSNOWDET01.DDS
+# no idea yet as to what these mean but in order to be able to load the texture from 
+# the s3d container we need to strip this stuff
+def cleanTextureName(name):
+    i = name.rfind(',')
+    if i != -1:
+        name = name[i+1:].strip()
+        
+    return name.lower()
+    
+
+# MATERIAL: one entry of a 0x31 texture list with the 0x30->0x05->0x04->0x03 reference chain resolved
+# kind is 'chain' for the normal reference chain, 'direct' for 0x30 fragments referencing a 0x03 fragment
+# directly and 'null' for those that point nowhere meaningful (zone walls in the old classic zones, these
+# get the dummy null texture)
+class Material():
+
+    OPAQUE = 'opaque'
+    MASKED = 'masked'
+    SEMI_TRANSPARENT = 'semi'
+    INVISIBLE = 'invisible'
+    
+    def __init__(self, list_id, index, name, material_name, flags, anim_delay, texnames, kind):
+        self.list_id = list_id          # id of the 0x31 fragment listing us
+        self.index = index              # our index in that list (that's how the meshes reference us)
+        self.name = name                # sprite name: the 0x04 name for the normal chain, the material name otherwise
+        self.material_name = material_name  # name of the 0x30 fragment
+        self.flags = flags              # the 0x30 params1 flags
+        self.anim_delay = anim_delay    # ms between animation frames, 0 if not animated
+        self.texnames = texnames        # texture file names, more than one for animated textures
+        self.kind = kind
+        
+        # transparency class, see Sprite for the meaning of the flag bits
+        if not flags & 0x80000000:
+            self.transparency = Material.INVISIBLE
+        elif flags & 0x00000004:
+            self.transparency = Material.SEMI_TRANSPARENT
+        elif flags & 0x00000002:
+            self.transparency = Material.MASKED
+        else:
+            self.transparency = Material.OPAQUE
+            
+    def toDict(self):
+        return { 'list_id' : self.list_id, 'index' : self.index, 'name' : self.name, 
+                 'material_name' : self.material_name, 'flags' : self.flags, 'anim_delay' : self.anim_delay,
+                 'texnames' : list(self.texnames), 'kind' : self.kind, 'transparency' : self.transparency }
+                 
+    @staticmethod
+    def fromDict(d):
+        return Material(d['list_id'], d['index'], d['name'], d['material_name'], d['flags'], d['anim_delay'],
+            list(d['texnames']), d['kind'])
+            
+    def dump(self):
+        print 'MATERIAL: %s list:%i index:%i kind:%s flags:0x%x transparency:%s anim_delay:%i textures:%s' % \
+            (self.name, self.list_id, self.index, self.kind, self.flags, self.transparency, self.anim_delay, 
+            ', '.join(self.texnames))
+            
    
 class WLDContainer():
     
@@ -90,6 +158,95 @@ class WLDContainer():
         self.sprite_list = {}
         self.animated_sprites = []  # Lists those sprites that are animated
         
+        # 0x31 fragment id -> list of Material objects (None for entries that can't be resolved)
+        self.materials = None       # see buildMaterials()
+        
+    # resolve the material reference chains of all 0x31 texture lists in our wld in one pass
+    def buildMaterials(self):
+        wld = self.wld_file_obj
+        self.materials = {}
+        for f31 in wld.getFragmentsByType(0x31):
+            materials = []
+            idx = 0
+            for ref30 in f31.nameRefs:
+                materials.append(self.resolveMaterial(wld, f31.id, idx, wld.getFragment(ref30)))
+                idx += 1
+            self.materials[f31.id] = materials
+            
+    # Returns the Material for a 0x30 fragment or None if its references can't be resolved
+    def resolveMaterial(self, wld, list_id, idx, f30):
+        material_name = wld.getName(f30.nameRef)
+        
+        # Note on TRANSPARENCY: as far as I can tell so far, bit 2 in the params1 field of f30
+        # is the "semi-transparent" indicator used for all types of water surfaces for the old
+        # zones (pre POP? Seems to not work like this in zones like POV for example anymore)
+        # lets go by this theory anyway for now
+        
+        # Note that there are frag05Refs inside some 0x30 fragments with value <=0 
+        # these named references seem to point directly to 0x03 texture fragments
+        # instead of the usual indirection chain  0x05->0x04->0x03
+        # in some instances these point nowhere meaningful at all though. Need to catch all these
+        frag = wld.getFragment(f30.frag05Ref)
+        if frag == None:
+            print 'Error in Material: could not resolve frag05ref:%i in 0x30 fragment:%i' % (f30.frag05Ref, f30.id)
+            return None
+            
+        if frag.type == 0x03:       # this is a direct 0x03 ref (see note above)
+            # we dont have a sprite def (0x04) for these, so we use the material (0x30) name
+            return Material(list_id, idx, material_name, material_name, f30.params1, 0, 
+                [cleanTextureName(frag.names[0])], 'direct')
+                
+        if frag.type == 0x05:       # this is the "normal" indirection chain 0x30->0x05->0x04->0x03
+            f04 = wld.getFragment(frag.frag04Ref)
+            texnames = []
+            for f03ref in f04.frag03Refs:
+                # NOTE that this assumes the zone 0x03 fragments only ever reference one single texture
+                texnames.append(cleanTextureName(wld.getFragment(f03ref).names[0]))
+            return Material(list_id, idx, wld.getName(f04.nameRef), material_name, f30.params1, f04.params2, 
+                texnames, 'chain')
+                
+        # This is the "does point nowhere meaningful at all" case
+        # infact the reference points back to the same fragment (circular)
+        # This type of 0x30 fragment seems  to only have been used for zone boundary polygons
+        # in the original EQ classic zones 
+        print 'Warning : Non standard material:%s. Texture ref in 0x30 frag is not type 0x5 or 0x3 but 0x%x' % \
+            (material_name, frag.type)
+        return Material(list_id, idx, material_name, material_name, f30.params1, 0, [], 'null')
+        
+    def getMaterial(self, list_id, index):
+        if self.materials == None:
+            return None
+            
+        materials = self.materials.get(list_id)
+        if materials == None or index < 0 or index >= len(materials):
+            return None
+            
+        return materials[index]
+        
+    # Returns the names of all texture files referenced by our materials (each name once)
+    def getTextureNames(self):
+        texnames = []
+        seen = {}
+        for list_id in sorted(self.materials.keys()):
+            for material in self.materials[list_id]:
+                if material != None:
+                    for texname in material.texnames:
+                        if not seen.has_key(texname):
+                            seen[texname] = 1
+                            texnames.append(texname)
+                        
+        return texnames
+        
+    # Returns the material table as a list of plain dicts (json/pickle friendly), None entries are left out
+    def materialsToList(self):
+        materials = []
+        for list_id in sorted(self.materials.keys()):
+            for material in self.materials[list_id]:
+                if material != None:
+                    materials.append(material.toDict())
+                    
+        return materials
+        
     # SPRITE LISTS represent the original structure of the 0x31 lists in a wld 
     def getSprite(self, sprite_index, list_index):
         if self.sprite_list.has_key(list_index):
@@ -127,13 +284,23 @@ class WLDFile():
         self.filename = name+'.wld'
                 
         # xor codes for the simple hash encoder
-        self.codes = [0x95, 0x3A, 0xC5, 0x2A, 0x95, 0x7A, 0x95, 0x6A]
+        self.codes = NAMEHASH_CODES
         
         self.names = None   # decoded namehash
+        self.name_table = {}    # namehash position -> name string, see buildNameTable()
         
-        self.known_fragments = [ 0x36, 0x31, 0x30, 0x2d, 0x15, 0x14, 0x13, 0x12, 0x11, 0x10, 0x5, 0x4, 0x3 ] 
+        self.known_fragments = fragment_codecs.types()     # the fragment types we have a codec for
         self.fragment_type_counts = {}
-        self.fragments = {}
+        
+        # fragments are loaded in two phases: load() only records the fragment headers, the fragments
+        # themselves get decoded the first time somebody asks for them (see getFragment())
+        # both lists are indexed by fragment id
+        self.data = None                # the wld file contents, kept around for decoding fragments later on
+        self.fragment_headers = []      # (offset, length, type, nameRef) of every fragment
+        self.fragments = []             # the decoded fragment objects, None where not decoded (yet)
+        self.fragment_ids_by_type = {}  # fragment type -> list of the ids of all fragments of that type
+        self.fragment_ids_by_name = {}  # fragment name -> id of the first known fragment carrying that name
+        self.fragment_ids_by_nameRef = {}   # same keyed by the fragment's nameRef
         
         self.dump_list = []     # list of fragment types to dump while loading
         
@@ -142,9 +309,10 @@ class WLDFile():
         
     # this simple hash encoder/decoder is used for the contents of the names string table 
     # (hence its designation as "namehash") and for several other types of data inside the wld
+    # bytes is a bytearray, it gets decoded in place
     def decodeBytes(self, bytes):
-        for i in range(0, len(bytes)):
-            bytes[i] = bytes[i] ^ self.codes[i & 7] 
+        for i in range(0, 8):
+            bytes[i::8] = bytes[i::8].translate(namehash_tables[i])
             
         return bytes
             
@@ -154,26 +322,38 @@ class WLDFile():
         else:
             self.fragment_type_counts[type] = 1
           
-    # return a name string from the namehash bytearray
-    # nameidx is the position pointer to the start of the name, it's end is marked
+    # split the decoded namehash into its C style 0 terminated names once
+    # the table maps the position of each name in the namehash to the name string
+    def buildNameTable(self):
+        self.name_table = {}
+        names = str(self.names)
+        position = 0
+        for name in names.split('\0')[:-1]:     # anything after the last terminator is not a name
+            self.name_table[position] = name
+            position += len(name) + 1
+            
+    def getNameTable(self):
+        return self.name_table
+        
+    # return a name string from the namehash
+    # nameidx is the negated position of the start of the name, it's end is marked
     # with a C style 0 byte
     def getName(self, nameidx):
         position = -nameidx
         if position == 0:
             return ''
             
-        name = self.names[position:]
-        # find the position of 0 byte terminator
-        i = 0
-        end = 0
-        for c in name:
-            if c == 0:
-                end = i
-                break;
-            i += 1
-         
-        name = name[0:end]        
-        return str(name)
+        name = self.name_table.get(position)
+        if name == None:
+            # a reference into the middle of a name: look for the terminator and remember the result
+            name = str(self.names[position:])
+            end = name.find('\0')
+            if end == -1:
+                end = 0
+            name = name[0:end]
+            self.name_table[position] = name
+            
+        return name
         
     # -------------------------------------------------------------------------
     # FRAGMENT decoders    
@@ -183,38 +363,25 @@ class WLDFile():
     
     def decodeFragment(self, id, type, nameRef, buf, offset):
         # print type
-        fragment = None
-        if type == 0x36:
-            fragment = Fragment36(id, type, nameRef, self)
-        elif type == 0x31:
-            fragment = Fragment31(id, type, nameRef, self)
-        elif type == 0x30:
-            fragment = Fragment30(id, type, nameRef, self)
-        elif type == 0x2D:
-            fragment = Fragment2D(id, type, nameRef, self)
-        elif type == 0x15:
-            fragment = Fragment15(id, type, nameRef, self)
-        elif type == 0x14:
-            fragment = Fragment14(id, type, nameRef, self)
-        elif type == 0x13:
-            fragment = Fragment13(id, type, nameRef, self)
-        elif type == 0x12:
-            fragment = Fragment12(id, type, nameRef, self)
-        elif type == 0x11:
-            fragment = Fragment11(id, type, nameRef, self)
-        elif type == 0x10:
-            fragment = Fragment10(id, type, nameRef, self)
-        elif type == 0x05:
-            fragment = Fragment05(id, type, nameRef, self)
-        elif type == 0x04:
-            fragment = Fragment04(id, type, nameRef, self)
-        elif type == 0x03:
-            fragment = Fragment03(id, type, nameRef, self)
-
-        fragment.decode(buf, offset)
+        fragment = fragment_codecs.decode(id, type, nameRef, self, buf, offset)
+        if fragment == None:
+            return None
+            
         self.fragments[fragment.id] = fragment
         if type in self.dump_list:
             fragment.dump()
+            
+        return fragment
+        
+    # decode the fragment with the given id unless that has happened already
+    # Returns the fragment object or None for unknown fragment types
+    def decodeFragmentById(self, id):
+        fragment = self.fragments[id]
+        if fragment == None:
+            (offset, length, type, nameRef) = self.fragment_headers[id]
+            fragment = self.decodeFragment(id, type, nameRef, self.data, offset)
+            
+        return fragment
         
 
     # -------------------------------------------------------------------------
@@ -223,12 +390,18 @@ class WLDFile():
         print 'WLDFile loading ', self.filename, ' from S3D container'
         
         s3dfile =  s3d.getFile(self.filename)
-        wld = s3dfile.data
+        if s3dfile == None:
+            print 'wld file not found in S3D container, aborting load'
+            return
+            
+        # all decoding works on a memoryview of the wld data: the decoders read at offsets through 
+        # unpack_from() and any slices they take are views, so nothing gets copied on the way
+        wld = memoryview(s3dfile.data)
         # print 'total length:', s3dfile.size
         
         # process WLD header
         offset = 0
-        (magic, version, max_fragment, dummy1, dummy2, name_hash_len) = struct.unpack('<iiiiii', wld[offset:offset+24])
+        (magic, version, max_fragment, dummy1, dummy2, name_hash_len) = struct.unpack_from('<iiiiii', wld, offset)
         offset += 28    # header length = 7 * u32
         
         version &= 0xffffffffe
@@ -248,20 +421,20 @@ class WLDFile():
         
         # process NAMEHASH
         # print 'name_hash length:', name_hash_len
-        format = '<'+str(name_hash_len)+'s'
-        (name_hash,) = struct.unpack(format, wld[offset:offset+name_hash_len])
+        # the namehash gets decoded in place, so this is the one copy we do need
+        self.names = self.decodeBytes(bytearray(wld[offset:offset+name_hash_len]))
         offset += name_hash_len
-        
-        self.names = self.decodeBytes(bytearray(name_hash))
+        self.buildNameTable()
         # self.names = str(self.names).split('\0')
         # print self.names
         
-        # load the FRAGMENTS
+        # index the FRAGMENTS: only the headers are read here, decoding happens on demand
+        self.data = wld
         sum_len = 0
         frag_id = 0
         for i in range(0, max_fragment):
             # fragment header
-            (fragment_len, fragment_type, fragment_name) = struct.unpack('<iii', wld[offset:offset+12])
+            (fragment_len, fragment_type, fragment_name) = struct.unpack_from('<iii', wld, offset)
             
             # fnam = self.getName(fragment_name)
             # print fnam, len(fnam)
@@ -269,8 +442,20 @@ class WLDFile():
             
             self.countFragmentType(fragment_type)       # keep some statistics on fragment type counts
             
-            if fragment_type in self.known_fragments:
-                self.decodeFragment(frag_id, fragment_type, fragment_name, wld, offset)
+            self.fragment_headers.append((offset, fragment_len, fragment_type, fragment_name))
+            if self.fragment_ids_by_type.has_key(fragment_type):
+                self.fragment_ids_by_type[fragment_type].append(frag_id)
+            else:
+                self.fragment_ids_by_type[fragment_type] = [frag_id]
+                
+            # name indexes for the named fragment references and getFragmentByName(), only fragments
+            # we can decode are of any use there
+            if fragment_name != 0 and fragment_type in self.known_fragments:
+                if not self.fragment_ids_by_nameRef.has_key(fragment_name):
+                    self.fragment_ids_by_nameRef[fragment_name] = frag_id
+                name = self.getName(fragment_name)
+                if not self.fragment_ids_by_name.has_key(name):
+                    self.fragment_ids_by_name[name] = frag_id
                 
             # fragment data
             sum_len += fragment_len + 8 # add the len and type fields (but not the name field, see below)
@@ -280,6 +465,12 @@ class WLDFile():
             frag_id += 1                # fragment id is simply its position in the file
         
         # print 'sum of all fragment lengths:', sum_len
+        self.fragments = [None] * frag_id
+        
+        # the fragment types on the dump list get decoded right away so that they show up during the load
+        for type in self.dump_list:
+            self.getFragmentsByType(type)
+            
         '''
         for k in self.fragment_type_counts.keys():
             print 'fragment type:0x%x count:%i' % (k, self.fragment_type_counts[k])
@@ -296,28 +487,44 @@ class WLDFile():
         # finally we need to look through all our fragments to find one with matches the name
         # whoever invented this nonsense should be bitch slapped silly
         if idx_plus_1 > 0:
-            try:
-                return self.fragments[idx_plus_1 - 1]
-            except:
+            if idx_plus_1 > len(self.fragments):
                 return None
+            return self.decodeFragmentById(idx_plus_1 - 1)
         
         nameRef = (idx_plus_1)-1
-        name = self.getName(nameRef)   # getName() expects a negated index, so we can pass as is
-        # print 'named frag reference:', name
-        for frag in self.fragments.values():
-            if frag.nameRef == nameRef:
-                return frag
+        # print 'named frag reference:', self.getName(nameRef)
+        id = self.fragment_ids_by_nameRef.get(nameRef)
+        if id == None:
+            return None
+            
+        return self.decodeFragmentById(id)
         
-        return None
+    # Returns a list of all fragments of the given type in fragment id order
+    def getFragmentsByType(self, type):
+        if type not in self.known_fragments:
+            return []
+            
+        return [self.decodeFragmentById(id) for id in self.fragment_ids_by_type.get(type, [])]
         
-    # find a fragment by its name
-    # we need to iterate over all our fragments: should this turn out to be too slow
-    # we need to implement a name directory that gets filled with data when we decode 
-    # our fragments initially
+    # find a fragment by its name using the name directory filled while the headers are indexed
+    # only the matching fragment gets decoded
     def getFragmentByName(self, name):
-        for f in self.fragments.values():
-            if f.name == name:
-                return f
+        id = self.fragment_ids_by_name.get(name)
+        if id == None:
+            return None
+            
+        return self.decodeFragmentById(id)
+        
+    # find a fragment by type and name
+    def getFragmentByTypeAndName(self, type, name):
+        id = self.fragment_ids_by_name.get(name)
+        if id != None and self.fragment_headers[id][2] == type:
+            return self.decodeFragmentById(id)
+            
+        # the name is taken by a fragment of another type
+        for id in self.fragment_ids_by_type.get(type, []):
+            if self.getName(self.fragment_headers[id][3]) == name:
+                return self.decodeFragmentById(id)
                 
         return None
         
\ No newline at end of file
@@ -0,0 +1,219 @@
+'''
+collider.py
+
+zone collision queries against the bsp region meshes
+(c) gsk 2012
+
+
+Copyright (c) 2012, Gedolian Soft Kram
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided 
+that the following conditions are met:
+
+    Redistributions of source code must retain the above copyright notice, this list of conditions 
+    and the following disclaimer.
+    Redistributions in binary form must reproduce the above copyright notice, this list of conditions 
+    and the following disclaimer in the documentation and/or other materials provided with the distribution.
+    Neither the name of the <ORGANIZATION> nor the names of its contributors may be used to endorse or 
+    promote products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR 
+IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND 
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR 
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, 
+OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; 
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY 
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+The RegionCollider keeps the collision triangles of the zone's 0x36 meshes grouped by the
+bsp region the mesh belongs to. A query first finds the regions it touches by walking the
+bsp tree (0x21) and then only tests the triangles of those regions, so its cost depends on
+the size of the regions involved instead of the size of the zone.
+
+'''
+
+import math
+
+# numpy is optional: with it each region's triangles are tested in one vectorized pass
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class RegionCollider():
+
+    EPSILON = 0.0001
+
+    def __init__(self, bsp_tree):
+        self.bsp_tree = bsp_tree
+        
+        # region index -> triangles of the region, -1 holds the triangles of meshes without a region
+        # every triangle is stored as its first corner a and the edges e1 = b-a and e2 = c-a:
+        # with numpy three (n, 3) float arrays (a, e1, e2), otherwise a list of 9-tuples
+        self.triangles = {}
+        self.pending = {}       # region index -> triangles added since the last finalize()
+        
+    # add the collision polygons (all but the passable ones) of a 0x36 fragment to a region
+    def addMesh(self, f, region):
+        polys = f.getCollisionPolygons()
+        if len(polys) == 0:
+            return
+            
+        # the fragment arrays are numpy arrays whenever numpy is around (see Fragment36)
+        if numpy != None:
+            vertices = f.vertexList + numpy.array([f.centerX, f.centerY, f.centerZ], numpy.float32)
+            corners = vertices[f.polyList[polys].astype(numpy.intp)]    # (n, 3 corners, xyz)
+            a = corners[:, 0]
+            self.pending.setdefault(region, []).append((a, corners[:, 1] - a, corners[:, 2] - a))
+            return
+            
+        vertices = f.vertexList
+        triangles = self.pending.setdefault(region, [])
+        for i in polys:
+            p = f.polyList[i]
+            a = vertices[p[0]]
+            b = vertices[p[1]]
+            c = vertices[p[2]]
+            ax = a[0] + f.centerX
+            ay = a[1] + f.centerY
+            az = a[2] + f.centerZ
+            triangles.append((ax, ay, az, b[0]+f.centerX-ax, b[1]+f.centerY-ay, b[2]+f.centerZ-az, 
+                c[0]+f.centerX-ax, c[1]+f.centerY-ay, c[2]+f.centerZ-az))
+                
+    # merge the triangles added per region into one block per region
+    def finalize(self):
+        for region, blocks in self.pending.items():
+            if numpy != None:
+                if self.triangles.has_key(region):
+                    blocks.insert(0, self.triangles[region])
+                self.triangles[region] = tuple(numpy.concatenate([b[i] for b in blocks]).astype(numpy.float64) 
+                    for i in range(0, 3))
+            else:
+                self.triangles.setdefault(region, []).extend(blocks)
+        self.pending = {}
+        
+    def getNumTriangles(self):
+        n = 0
+        for triangles in self.triangles.values():
+            if numpy != None:
+                n += len(triangles[0])
+            else:
+                n += len(triangles)
+        return n
+        
+    # Returns the height of the highest triangle of the region straight below (or at) the point 
+    # that is at most max_drop below it, or None if there is none
+    def groundHit(self, region, x, y, z, max_drop):
+        triangles = self.triangles.get(region)
+        if triangles == None:
+            return None
+            
+        if numpy != None:
+            (a, e1, e2) = triangles
+            den = e1[:, 0]*e2[:, 1] - e2[:, 0]*e1[:, 1]
+            px = x - a[:, 0]
+            py = y - a[:, 1]
+            # vertical triangles (den == 0) give nan/inf here, they get masked out below
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                u = (px*e2[:, 1] - e2[:, 0]*py) / den
+                v = (e1[:, 0]*py - px*e1[:, 1]) / den
+                hz = a[:, 2] + u*e1[:, 2] + v*e2[:, 2]
+                hit = (den != 0) & (u >= 0) & (v >= 0) & (u + v <= 1) & (hz <= z + self.EPSILON) & (hz >= z - max_drop)
+            if not hit.any():
+                return None
+            return float(hz[hit].max())
+            
+        ground = None
+        for (ax, ay, az, e1x, e1y, e1z, e2x, e2y, e2z) in triangles:
+            den = e1x*e2y - e2x*e1y
+            if den == 0:
+                continue
+            px = x - ax
+            py = y - ay
+            u = (px*e2y - e2x*py) / den
+            v = (e1x*py - px*e1y) / den
+            if u < 0 or v < 0 or u + v > 1:
+                continue
+            hz = az + u*e1z + v*e2z
+            if hz <= z + self.EPSILON and hz >= z - max_drop and (ground == None or hz > ground):
+                ground = hz
+        return ground
+        
+    # Returns 1 if the line segment from p0 to p1 crosses a triangle of the region, 0 otherwise
+    def segmentHit(self, region, x0, y0, z0, x1, y1, z1):
+        triangles = self.triangles.get(region)
+        if triangles == None:
+            return 0
+            
+        # Moeller-Trumbore with the segment direction not normalized: hits are at 0 <= t <= 1
+        # det scales with the lengths of the edges and the segment, so does the parallel tolerance
+        d = (x1-x0, y1-y0, z1-z0)
+        dlen = math.sqrt(d[0]*d[0] + d[1]*d[1] + d[2]*d[2])
+        if numpy != None:
+            (a, e1, e2) = triangles
+            d = numpy.array(d)
+            pvec = numpy.cross(d, e2)
+            det = (e1*pvec).sum(1)
+            tolerance = self.EPSILON * dlen * numpy.sqrt((e1*e1).sum(1) * (e2*e2).sum(1))
+            with numpy.errstate(divide='ignore', invalid='ignore'):
+                inv = 1.0 / det
+                tvec = numpy.array([x0, y0, z0]) - a
+                u = (tvec*pvec).sum(1) * inv
+                qvec = numpy.cross(tvec, e1)
+                v = (qvec*d).sum(1) * inv
+                t = (e2*qvec).sum(1) * inv
+                hit = (abs(det) > tolerance) & (u >= 0) & (v >= 0) & (u + v <= 1) & (t >= 0) & (t <= 1)
+            return int(hit.any())
+            
+        for (ax, ay, az, e1x, e1y, e1z, e2x, e2y, e2z) in triangles:
+            px = d[1]*e2z - d[2]*e2y
+            py = d[2]*e2x - d[0]*e2z
+            pz = d[0]*e2y - d[1]*e2x
+            det = e1x*px + e1y*py + e1z*pz
+            tolerance = self.EPSILON * dlen * math.sqrt((e1x*e1x + e1y*e1y + e1z*e1z) * (e2x*e2x + e2y*e2y + e2z*e2z))
+            if abs(det) <= tolerance:
+                continue
+            inv = 1.0 / det
+            tx = x0 - ax
+            ty = y0 - ay
+            tz = z0 - az
+            u = (tx*px + ty*py + tz*pz) * inv
+            if u < 0 or u > 1:
+                continue
+            qx = ty*e1z - tz*e1y
+            qy = tz*e1x - tx*e1z
+            qz = tx*e1y - ty*e1x
+            v = (d[0]*qx + d[1]*qy + d[2]*qz) * inv
+            if v < 0 or u + v > 1:
+                continue
+            t = (e2x*qx + e2y*qy + e2z*qz) * inv
+            if t >= 0 and t <= 1:
+                return 1
+        return 0
+        
+    # Returns the height of the ground below the point (at most max_drop below it) or None 
+    # if there is no ground there. The regions below the point are tested top down, the first one 
+    # holding a triangle below the point has the ground
+    def getGroundHeight(self, x, y, z, max_drop):
+        ground = None
+        for region in self.bsp_tree.findRegionsAlongSegment(x, y, z, x, y, z - max_drop):
+            ground = self.groundHit(region, x, y, z, max_drop)
+            if ground != None:
+                break
+                
+        # the meshes we could not place into a region get tested every time
+        h = self.groundHit(-1, x, y, z, max_drop)
+        if h != None and (ground == None or h > ground):
+            ground = h
+        return ground
+        
+    # Returns 1 if there is a solid triangle between the two points
+    def isBlocked(self, x0, y0, z0, x1, y1, z1):
+        for region in self.bsp_tree.findRegionsAlongSegment(x0, y0, z0, x1, y1, z1) + [-1]:
+            if self.segmentHit(region, x0, y0, z0, x1, y1, z1) == 1:
+                return 1
+        return 0
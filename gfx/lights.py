@@ -0,0 +1,151 @@
+'''
+lights.py
+
+static zone lights
+(c) gsk 2012
+
+
+Copyright (c) 2012, Gedolian Soft Kram
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided 
+that the following conditions are met:
+
+    Redistributions of source code must retain the above copyright notice, this list of conditions 
+    and the following disclaimer.
+    Redistributions in binary form must reproduce the above copyright notice, this list of conditions 
+    and the following disclaimer in the documentation and/or other materials provided with the distribution.
+    Neither the name of the <ORGANIZATION> nor the names of its contributors may be used to endorse or 
+    promote products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR 
+IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND 
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR 
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, 
+OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; 
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY 
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+The zone's point lights are placed by 0x28 fragments in lights.wld, the per region ambient
+lights are 0x2A fragments in the zone wld. Both reference their color through a 0x1C light
+source reference to a 0x1B light source.
+
+Every zone mesh only gets the few point lights nearest to it (and the ambient light of its
+region) assigned once at load time, so panda doesn't have to evaluate all the zone's lights
+for every geom. The zone lights replace the viewer's global lights on the zone meshes: the
+global directional light is turned off for all of them if the zone has static lights at all,
+the global ambient light for those whose region has an ambient light of its own. The camera
+light stays.
+
+'''
+
+from panda3d.core import PandaNode, NodePath, PointLight, AmbientLight, VBase4, Point3
+
+# numpy is optional: it speeds up the nearest light search for zones with lots of lights
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class ZoneLights():
+
+    # global_ambient and global_directional are the NodePaths of the viewer's render wide lights
+    def __init__(self, name, max_lights, global_ambient, global_directional):
+        self.name = name
+        self.max_lights = max_lights    # max number of point lights per mesh
+        self.global_ambient = global_ambient
+        self.global_directional = global_directional
+        
+        # the light nodes hang under their own root, the zone parents it once the zone geometry is flattened
+        self.root = NodePath(PandaNode(name+'_lights'))
+        
+        self.lights = []                # (x, y, z, radius, NodePath) of every point light
+        self.positions = None           # with numpy: (n, 3) light positions and their radii
+        self.radii = None
+        self.ambient_lights = {}        # region index -> ambient light NodePath
+        
+    # follow a 0x1C light source reference to its 0x1B light source
+    # Returns the 0x1B fragment or None
+    def getLightSource(self, wld, ref):
+        f = wld.getFragment(ref)
+        if f == None or f.type != 0x1C:
+            return None
+        f = wld.getFragment(f.fragRef)
+        if f == None or f.type != 0x1B:
+            return None
+        return f
+        
+    # create the point lights placed by the 0x28 fragments of a wld file (lights.wld)
+    def loadPointLights(self, wld):
+        for f in wld.getFragmentsByType(0x28):
+            source = self.getLightSource(wld, f.fragRef)
+            if source == None or f.radius <= 0:
+                continue
+                
+            (r, g, b) = source.getColor()
+            light = PointLight('%s_light_%i' % (self.name, len(self.lights)))
+            light.setColor(VBase4(r, g, b, 1.0))
+            # quadratic falloff down to a fifth of the light's strength at its radius
+            light.setAttenuation(Point3(1.0, 0.0, 4.0/(f.radius*f.radius)))
+            np = self.root.attachNewNode(light)
+            np.setPos(f.x, f.y, f.z)
+            self.lights.append((f.x, f.y, f.z, f.radius, np))
+            
+        if numpy != None and len(self.lights) > 0:
+            self.positions = numpy.array([l[0:3] for l in self.lights])
+            self.radii = numpy.array([l[3] for l in self.lights])
+            
+    # create the per region ambient lights of the 0x2A fragments of a wld file (the zone wld)
+    def loadAmbientLights(self, wld):
+        for f in wld.getFragmentsByType(0x2A):
+            source = self.getLightSource(wld, f.fragRef)
+            if source == None:
+                continue
+                
+            (r, g, b) = source.getColor()
+            light = AmbientLight('%s_ambient_%i' % (self.name, f.id))
+            light.setColor(VBase4(r, g, b, 1.0))
+            np = self.root.attachNewNode(light)
+            for region in f.regions:
+                self.ambient_lights[region] = np
+                
+    # Returns the NodePaths of the (at most max_lights) point lights nearest to the sphere at x,y,z
+    # Only lights that reach into the sphere are considered
+    def getNearestLights(self, x, y, z, radius):
+        if len(self.lights) == 0 or self.max_lights <= 0:
+            return []
+            
+        if numpy != None:
+            d = numpy.sqrt(((self.positions - (x, y, z))**2).sum(1))
+            reach = numpy.flatnonzero(d - radius < self.radii)
+            nearest = reach[numpy.argsort(d[reach], kind='mergesort')[:self.max_lights]]
+            return [self.lights[i][4] for i in nearest]
+            
+        near = []
+        for light in self.lights:
+            d = ((light[0]-x)**2 + (light[1]-y)**2 + (light[2]-z)**2) ** 0.5
+            if d - radius < light[3]:
+                near.append((d, light[4]))
+        near.sort(key=lambda l: l[0])
+        return [l[1] for l in near[:self.max_lights]]
+        
+    def hasLights(self):
+        return len(self.lights) > 0 or len(self.ambient_lights) > 0
+        
+    # turn on the nearest point lights of the sphere at x,y,z and the ambient light of its region 
+    # (-1 for none) for the node, in place of the global lights
+    def applyLights(self, nodepath, x, y, z, radius, region):
+        if not self.hasLights():
+            return
+            
+        nodepath.setLightOff(self.global_directional)
+        for np in self.getNearestLights(x, y, z, radius):
+            nodepath.setLight(np)
+            
+        ambient = self.ambient_lights.get(region)
+        if ambient != None:
+            nodepath.setLightOff(self.global_ambient)
+            nodepath.setLight(ambient)
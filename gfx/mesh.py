@@ -32,11 +32,40 @@ OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMA
 
 
 
-from panda3d.core import  Geom, GeomVertexData, GeomVertexFormat, GeomVertexWriter
+from panda3d.core import  Geom, GeomVertexData, GeomVertexFormat, GeomVertexWriter, GeomTriangles, GeomNode
+from panda3d.core import GeomVertexArrayFormat, InternalName
 from panda3d.core import PandaNode, NodePath
 
+from file.wldfile import Material
 from polygroup import PolyGroup
               
+# the 0x36 fragment data comes as lists or, if numpy is available, as numpy arrays (see Fragment36)
+# numpy arrays are turned into lists in one go so that the vertex writers get plain python numbers
+def rows(data):
+    if isinstance(data, list):
+        return data
+    return data.tolist()
+    
+# the vertex format of meshes with animated vertices: the same columns as GeomVertexFormat.getV3n3cpt2()
+# but the vertex positions in an array of their own, so that the morph engine (see gfx/morph.py) can 
+# replace them with a single write per frame
+morph_vertex_format = None
+
+def getMorphVertexFormat():
+    global morph_vertex_format
+    if morph_vertex_format == None:
+        std = GeomVertexFormat.getV3n3cpt2()
+        positions = GeomVertexArrayFormat()
+        positions.addColumn(std.getColumn(InternalName.getVertex()))
+        attributes = GeomVertexArrayFormat(std.getArray(0))
+        attributes.removeColumn(InternalName.getVertex())
+        attributes.pack()
+        fmt = GeomVertexFormat()
+        fmt.addArray(positions)
+        fmt.addArray(attributes)
+        morph_vertex_format = GeomVertexFormat.registerFormat(fmt)
+    return morph_vertex_format
+    
 
 # The Mesh class holds all the vertex data and references to the PolyGroups (GEOMs)
 # that make up one mesh, where a mesh is a more or less arbitrary piece of geometry
@@ -55,27 +84,52 @@ class Mesh():
         # GeomVertexFormat.getV3n3cpt2()- vertex, normal, rgba, uv
         
         # textured
-        self.vdata = GeomVertexData(name, GeomVertexFormat.getV3n3cpt2(), Geom.UHStatic)
+        self.createVertexData(GeomVertexFormat.getV3n3cpt2(), Geom.UHStatic)
         
         # plain color filled polys
-        # self.vdata = GeomVertexData(name, GeomVertexFormat.getV3cp(), Geom.UHStatic)
+        # self.createVertexData(GeomVertexFormat.getV3cp(), Geom.UHStatic)
         
+        self.root = NodePath(PandaNode(name+'_mesh'))
+        self.collision = None   # NodePath of the collision geometry, see buildCollision()
+        self.animated_vertices = None   # the 0x37 fragment if the mesh has animated vertices
+        
+    def createVertexData(self, format, usage):
+        self.vdata = GeomVertexData(self.name, format, usage)
         self.vertex = GeomVertexWriter(self.vdata, 'vertex')
         self.vnormal = GeomVertexWriter(self.vdata, 'normal')
         self.color = GeomVertexWriter(self.vdata, 'color')
         self.texcoord = GeomVertexWriter(self.vdata, 'texcoord')
         
-        self.root = NodePath(PandaNode(name+'_mesh'))
+    # follow the 0x36 fragment's 0x2F reference to its 0x37 animated vertices
+    # Returns the 0x37 fragment or None if the mesh is not animated
+    def getAnimatedVertices(self, f, wld_container):
+        if f.fragment2 == 0:
+            return None
+        wld = wld_container.wld_file_obj
+        f2f = wld.getFragment(f.fragment2)
+        if f2f == None or f2f.type != 0x2F:
+            return None
+        f37 = wld.getFragment(f2f.fragRef)
+        if f37 == None or f37.type != 0x37 or f37.vertexCount != f.vertexCount or f37.frameCount == 0:
+            return None
+        return f37
         
     # f is a 0x36 mesh fragment (see fragment.py for reference)
-    def buildFromFragment(self, f, wld_container,debug=False):
+    # polygons using invisible materials are left out of the render geometry, with collision=1
+    # a separate collision geometry gets built as well (see buildCollision())
+    def buildFromFragment(self, f, wld_container,debug=False, collision=0):
         
+        # animated meshes get the vertex format the morph engine can write to
+        self.animated_vertices = self.getAnimatedVertices(f, wld_container)
+        if self.animated_vertices != None:
+            self.createVertexData(getMorphVertexFormat(), Geom.UHDynamic)
+            
         # write vertex coordinates
-        for v in f.vertexList:
+        for v in rows(f.vertexList):
             self.vertex.addData3f(v[0], v[1], v[2])
 
         # write vertex colors
-        for rgba in f.vertexColorsList:
+        for rgba in rows(f.vertexColorsList):
             '''
             r = (rgba & 0xff000000) >> 24
             g = (rgba & 0x00ff0000) >> 16
@@ -87,11 +141,11 @@ class Mesh():
             self.color.addData1f(rgba)
 
         # write vertex normals
-        for v in f.vertexNormalsList:
+        for v in rows(f.vertexNormalsList):
             self.vnormal.addData3f(v[0], v[1], v[2])
             
         # write texture uv
-        for uv in f.uvList:
+        for uv in rows(f.uvList):
             self.texcoord.addData2f(uv[0], uv[1])
             
         # Build PolyGroups
@@ -103,6 +157,12 @@ class Mesh():
             n_polys = pt[0]
             tex_idx = pt[1]
 
+            # invisible polygons (zone walls) are only of interest for collisions
+            material = wld_container.getMaterial(f.fragment1-1, tex_idx)
+            if material != None and material.transparency == Material.INVISIBLE:
+                poly_idx += n_polys
+                continue
+                
             if debug:
                 print("  Bulding a poly group with tex_id " + str(tex_idx))
             pg = PolyGroup(self.vdata, tex_idx)
@@ -116,3 +176,28 @@ class Mesh():
         
         if poly_idx != f.polyCount or poly_idx != len(f.polyList):
             print 'ERROR: polycount mismatch'
+            
+        if collision == 1:
+            self.buildCollision(f)
+            
+    # build the collision geometry: all polygons of the fragment except the passable ones (foliage etc)
+    # this includes the invisible polygons left out of the render geometry
+    # the geometry shares our vertex data, it is not parented to our root: the caller decides where it goes
+    def buildCollision(self, f):
+        polys = f.getCollisionPolygons()
+        if len(polys) == 0:
+            return
+            
+        poly_list = rows(f.polyList)
+        primitives = GeomTriangles(Geom.UHStatic)
+        for i in polys:
+            p = poly_list[i]
+            primitives.addVertices(p[0], p[1], p[2])
+            
+        geom = Geom(self.vdata)
+        geom.addPrimitive(primitives)
+        node = GeomNode(self.name+'_collision')
+        node.addGeom(geom)
+        
+        self.collision = NodePath(node)
+        self.collision.setPos(f.centerX, f.centerY, f.centerZ)     # same placement as our PolyGroups
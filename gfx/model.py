@@ -53,14 +53,13 @@ class ModelManager():
     def loadPlaceables(self, wld_file_obj):
         # We need to a.) find all distinct models referenced here and 
         # b.) store the reference data so that we can actually spawn the placeables later on
-        for f in wld_file_obj.fragments.values():
-            if f.type == 0x15:
-                # f.dump()
-                self.placeables_fragments.append(f)     # store the f15 ref
-                name = f.refName
-                if not self.models.has_key(name):
-                    m = Model(self, name)
-                    self.models[name] = m
+        for f in wld_file_obj.getFragmentsByType(0x15):
+            # f.dump()
+            self.placeables_fragments.append(f)     # store the f15 ref
+            name = f.refName
+            if not self.models.has_key(name):
+                m = Model(self, name)
+                self.models[name] = m
         
         # load all referenced models
         for model in self.models.values():
@@ -129,6 +128,7 @@ class Model():
     def createStaticModel(self, f36):
         m = Mesh(self.name+'_mesh')
         m.buildFromFragment(f36, self.wld_container,False)
+        self.mm.zone.morph_engine.addMesh(m)
         self.meshes.append(m)
         self.loaded = 1
         
@@ -155,6 +155,7 @@ class Model():
 
                 m = Mesh(self.name+'_mesh_'+str(i))
                 m.buildFromFragment(f36, self.wld_container, False)
+                self.mm.zone.morph_engine.addMesh(m)
                 m.root.reparentTo(root_mesh.root)
             else: # the root node (index 0) does not have a mesh
                 m = Mesh(self.name+'_mesh_'+str(i))  # empty dummy mesh
@@ -193,7 +194,7 @@ class Model():
         f14 = None
         for c in self.mm.container_directory.values():
             if c.type == 'obj':
-                f14 = c.wld_file_obj.getFragmentByName(self.name)
+                f14 = c.wld_file_obj.getFragmentByTypeAndName(0x14, self.name)
                 if f14 != None:
                     self.wld_container = c  # ok , this is "our" wld container
                     break;
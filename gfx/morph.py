@@ -0,0 +1,113 @@
+'''
+morph.py
+
+vertex animation (0x37 animated vertices) for meshes
+(c) gsk 2012
+
+
+Copyright (c) 2012, Gedolian Soft Kram
+All rights reserved.
+
+Redistribution and use in source and binary forms, with or without modification, are permitted provided 
+that the following conditions are met:
+
+    Redistributions of source code must retain the above copyright notice, this list of conditions 
+    and the following disclaimer.
+    Redistributions in binary form must reproduce the above copyright notice, this list of conditions 
+    and the following disclaimer in the documentation and/or other materials provided with the distribution.
+    Neither the name of the <ORGANIZATION> nor the names of its contributors may be used to endorse or 
+    promote products derived from this software without specific prior written permission.
+
+THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND ANY EXPRESS OR 
+IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND 
+FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT HOLDER OR 
+CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, 
+OR CONSEQUENTIAL DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES; 
+LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND ON ANY THEORY OF LIABILITY, 
+WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY 
+OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+
+Meshes with animated vertices (swaying trees, flags) cycle through the complete vertex
+position sets of their 0x37 fragment. The MorphEngine works out the current frame of all
+registered meshes in one go and only touches the meshes whose frame has changed: their
+vertex position array (see getMorphVertexFormat() in mesh.py) gets replaced with the new
+frame's positions in a single write.
+
+'''
+
+# numpy is optional: with it the frame numbers of all meshes are computed in one vectorized pass
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class MorphEngine():
+
+    DEFAULT_DELAY = 100     # ms between frames for fragments that don't specify a delay
+
+    def __init__(self):
+        self.vdatas = []        # vertex data of the registered meshes
+        self.frames = []        # their 0x37 frames (see Fragment37)
+        self.delays = []        # ms between frames
+        self.frame_counts = []
+        self.current = []       # the frame currently in the vertex data, -1 for none yet
+        
+        # with numpy the update works on array copies of the lists above, rebuilt after meshes were added
+        self.arrays = None      # (delays, frame_counts, current)
+        
+    # register a Mesh with animated vertices, meshes instanced into several placeables only need
+    # to be registered once
+    def addMesh(self, mesh):
+        f37 = mesh.animated_vertices
+        if f37 == None:
+            return
+            
+        if self.arrays != None:
+            self.current = self.arrays[2].tolist()
+            self.arrays = None
+            
+        self.vdatas.append(mesh.vdata)
+        self.frames.append(f37.frames)
+        if f37.delay > 0:
+            self.delays.append(f37.delay)
+        else:
+            self.delays.append(self.DEFAULT_DELAY)
+        self.frame_counts.append(f37.frameCount)
+        self.current.append(-1)
+        
+    def getNumMeshes(self):
+        return len(self.vdatas)
+        
+    # bring the vertex positions of all meshes up to date, time is in seconds
+    def update(self, time):
+        if len(self.vdatas) == 0:
+            return
+            
+        ms = int(time * 1000)
+        if numpy != None:
+            if self.arrays == None:
+                self.arrays = (numpy.array(self.delays, numpy.int64), numpy.array(self.frame_counts, numpy.int64),
+                    numpy.array(self.current, numpy.int64))
+            (delays, frame_counts, current) = self.arrays
+            frame = (ms // delays) % frame_counts
+            changed = numpy.flatnonzero(frame != current)
+            current[changed] = frame[changed]
+            for i in changed.tolist():
+                self.writeFrame(i, int(frame[i]))
+        else:
+            for i in range(0, len(self.vdatas)):
+                frame = (ms // self.delays[i]) % self.frame_counts[i]
+                if frame != self.current[i]:
+                    self.current[i] = frame
+                    self.writeFrame(i, frame)
+                    
+    # replace the vertex positions of mesh i with those of the frame
+    def writeFrame(self, i, frame):
+        data = self.frames[i][frame]
+        if numpy != None:
+            data = data.tobytes()
+        else:
+            data = data.tostring()
+        self.vdatas[i].modifyArray(0).modifyHandle().setData(data)
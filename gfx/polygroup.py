@@ -69,11 +69,10 @@ class PolyGroup():
         self.sprite_list_index = f.fragment1-1        # the fragment1 ref is used as sprite list index
         sprite = wld_container.getSprite(tex_idx, self.sprite_list_index)
             
-        polyList = f.polyList
-        poly_idx = start_index
-        for poly in range(0, n_polys):
-            p = polyList[poly_idx]
-            poly_idx += 1
+        polys = f.polyList[start_index:start_index+n_polys]
+        if not isinstance(polys, list):
+            polys = polys.tolist()      # numpy array of vertex indices, see Fragment36
+        for p in polys:
             self.primitives.addVertices(p[0], p[1], p[2])
 
         self.node = GeomNode(self.name)
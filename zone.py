@@ -50,6 +50,7 @@ The main (shortname.s3d) s3d file contains a bunch of textures and 3 .wld files
 
 import struct
 import zlib
+import array
 
 from panda3d.core import Geom, GeomVertexData, GeomVertexFormat, GeomVertexWriter, GeomTriangles, GeomNode, CullFaceAttrib
 from panda3d.core import PNMImage, Texture, StringStream
@@ -59,12 +60,16 @@ from panda3d.core import CollisionNode, CollisionSolid
 
 from file.s3dfile import S3DFile
 from file.wldfile import WLDFile, WLDContainer
+from file.fragment import fragment_codecs, REGION_WATER, REGION_LAVA, REGION_PVP, REGION_ZONELINE
 from file.ddsfile import DDSFile
 from gfx.polygroup import PolyGroup
 from gfx.model import ModelManager, Model
 from gfx.mesh import Mesh
 from gfx.texture import TextureManager
 from gfx.sprite import Sprite
+from gfx.collider import RegionCollider
+from gfx.lights import ZoneLights
+from gfx.morph import MorphEngine
 
 
 
@@ -97,6 +102,34 @@ class Zone():
         self.rootNode = NodePath(PandaNode("zone_root"))
         self.rootNode.reparentTo(render)
         
+        # the zone geometry used for collisions is kept apart from the render geometry
+        self.collisionRoot = NodePath(PandaNode("zone_collision"))
+        
+        # bsp tree (0x21) and regions (0x22) of the zone, see loadBsp()
+        self.bsp_tree = None
+        self.bsp_regions = []
+        
+        # with pvs culling the zone meshes are kept in one node per bsp region (region index -> NodePath)
+        # meshes we can't place in a region go into the always visible region_root
+        self.pvs_culling = self.world.pvs_culling
+        self.region_nodes = {}
+        self.region_root = None
+        self.camera_region = None       # the bsp region the camera was in at the last visibility update
+        
+        # walk mode ground and wall queries against the region meshes, None if the zone has no bsp tree
+        # (the collisionRoot geometry and the panda collision traverser are used then)
+        self.collider = None
+        
+        # region flags (water, lava, pvp, zone line) as one byte per bsp region, see loadRegionFlags()
+        self.region_flags = None
+        self.zone_lines = {}            # region index -> ZoneLine destination
+        
+        # static zone lights, see load()
+        self.lights = None
+        
+        # vertex animation of the placeables' meshes (the models register their animated meshes)
+        self.morph_engine = MorphEngine()
+        
         self.delta_t = 0
         
     # This currently only updates the direct zone sprites
@@ -104,6 +137,11 @@ class Zone():
         if self.load_complete != 1:
             return
             
+        if self.pvs_culling == 1:
+            self.updateVisibility()
+            
+        self.morph_engine.update(globalClock.getFrameTime())
+            
         # print 'update delta_t:', globalClock.getDt()
         self.delta_t += globalClock.getDt()
         if self.delta_t > 0.2:
@@ -112,116 +150,201 @@ class Zone():
                   for sprite in self.wld_containers[container].animated_sprites:
                       sprite.update()
         
+    # show only the region meshes in the potentially visible set of the camera's bsp region
+    # the node states only change when the camera moves into another region
+    def updateVisibility(self):
+        pos = base.camera.getPos(self.rootNode)
+        region = self.getRegionAt(pos.getX(), pos.getY(), pos.getZ())
+        if region == self.camera_region:
+            return
+        self.camera_region = region
+        
+        visible = None
+        if region != -1:
+            visible = self.bsp_regions[region].getVisibleRegions()
+            
+        # outside of the tree or no visibility list for this region: draw everything
+        if visible == None:
+            for node in self.region_nodes.values():
+                node.show()
+            return
+            
+        visible = set(visible)
+        visible.add(region)
+        for r, node in self.region_nodes.items():
+            if r in visible:
+                node.show()
+            else:
+                node.hide()
+        
+    # load the zone's bsp tree and regions
+    def loadBsp(self, wld_obj):
+        trees = wld_obj.getFragmentsByType(0x21)
+        if len(trees) > 0:
+            self.bsp_tree = trees[0]
+        self.bsp_regions = wld_obj.getFragmentsByType(0x22)
+        
+    # collect the 0x29 region flag fragments into one flag byte per region
+    def loadRegionFlags(self, wld_obj):
+        self.region_flags = array.array('B', [0]) * len(self.bsp_regions)
+        self.zone_lines = {}
+        for f in wld_obj.getFragmentsByType(0x29):
+            for region in f.regions:
+                if region < 0 or region >= len(self.region_flags):
+                    continue
+                self.region_flags[region] |= f.regionFlags
+                if f.zoneLine != None:
+                    self.zone_lines[region] = f.zoneLine
+                    
+    # Returns the REGION_ flags (see fragment.py) that apply at the point
+    def getRegionFlagsAt(self, x, y, z):
+        region = self.getRegionAt(x, y, z)
+        if region == -1:
+            return 0
+        return self.region_flags[region]
+        
+    # Returns the ZoneLine destination of the zone line at the point or None
+    def getZoneLineAt(self, x, y, z):
+        region = self.getRegionAt(x, y, z)
+        if region == -1 or not self.region_flags[region] & REGION_ZONELINE:
+            return None
+        return self.zone_lines.get(region)
+        
+    # Returns a short description of the region flags at the point for display
+    def getRegionText(self, x, y, z):
+        flags = self.getRegionFlagsAt(x, y, z)
+        names = [name for (flag, name) in ((REGION_WATER, 'water'), (REGION_LAVA, 'lava'), (REGION_PVP, 'pvp')) 
+            if flags & flag]
+        zone_line = self.getZoneLineAt(x, y, z)
+        if zone_line != None:
+            names.append('zone line to '+str(zone_line))
+        return ' '.join(names)
+        
+    # Returns the index of the bsp region the point lies in or -1 if it is not in any region
+    def getRegionAt(self, x, y, z):
+        if self.bsp_tree == None:
+            return -1
+            
+        region = self.bsp_tree.findRegion(x, y, z)
+        if region >= len(self.bsp_regions):
+            return -1
+        return region
+        
+    # Returns the ground height below the point (at most max_drop below it) or None if there's no ground
+    def getGroundHeight(self, x, y, z, max_drop):
+        return self.collider.getGroundHeight(x, y, z, max_drop)
+        
+    # Returns 1 if the zone geometry blocks the way from p0 to p1 (Point3's), 0 otherwise
+    def isMoveBlocked(self, p0, p1):
+        return self.collider.isBlocked(p0.getX(), p0.getY(), p0.getZ(), p1.getX(), p1.getY(), p1.getZ())
+        
+    # Returns a dict mapping the ids of the zone's 0x36 meshes to the index of their bsp region
+    # Regions reference their mesh. If a reference doesn't lead to a mesh we fall back to the 
+    # mesh names: zone meshes are called R<region number>_DMSPRITEDEF
+    def getMeshRegions(self, wld_obj):
+        mesh_regions = {}
+        for r in range(0, len(self.bsp_regions)):
+            ref = self.bsp_regions[r].meshRef
+            if ref > 0 and ref <= len(wld_obj.fragment_headers) and wld_obj.fragment_headers[ref-1][2] == 0x36:
+                mesh_regions[ref-1] = r
+                
+        for id in wld_obj.fragment_ids_by_type.get(0x36, []):
+            if mesh_regions.has_key(id):
+                continue
+            name = wld_obj.getName(wld_obj.fragment_headers[id][3])
+            if name.startswith('R') and name.endswith('_DMSPRITEDEF') and name[1:-12].isdigit():
+                region = int(name[1:-12]) - 1
+                if region >= 0 and region < len(self.bsp_regions):
+                    mesh_regions[id] = region
+                    
+        return mesh_regions
+        
     # build the main zone geometry mesh
     def prepareZoneMesh(self):
         wld_container = self.wld_containers['zone']
         wld_obj = wld_container.wld_file_obj
         
+        self.loadBsp(wld_obj)
+        self.loadRegionFlags(wld_obj)
+        mesh_regions = {}
+        if self.bsp_tree != None:
+            mesh_regions = self.getMeshRegions(wld_obj)
+            self.collider = RegionCollider(self.bsp_tree)
+        if self.pvs_culling == 1:
+            self.region_root = self.rootNode.attachNewNode(PandaNode('regions_unassigned'))
+        
         # load the 0x36 bsp region fragments (sub meshes): all these meshes together
         # make up the main zone geometry
-        for f in wld_obj.fragments.values():
-            if f.type == 0x36:
-                # print 'adding fragment_36 to main zone mesh'
-                # f.dump()
-                m = Mesh(self.name)
+        for f in wld_obj.getFragmentsByType(0x36):
+            # print 'adding fragment_36 to main zone mesh'
+            # f.dump()
+            m = Mesh(self.name)
+            if self.collider != None:
                 m.buildFromFragment(f, wld_container)
+                self.collider.addMesh(f, mesh_regions.get(f.id, -1))
+            else:
+                m.buildFromFragment(f, wld_container, collision=1)
+            if self.lights != None:
+                # set before the flatten, which pushes the lights down into the geoms' states
+                self.lights.applyLights(m.root, f.centerX, f.centerY, f.centerZ, f.maxDist, mesh_regions.get(f.id, -1))
+            if self.pvs_culling == 1:
+                # one node per region so that regions can be shown/hidden on their own
+                region = mesh_regions.get(f.id)
+                if region == None:
+                    m.root.reparentTo(self.region_root)
+                else:
+                    if not self.region_nodes.has_key(region):
+                        self.region_nodes[region] = self.rootNode.attachNewNode(PandaNode('region_%i' % region))
+                    m.root.reparentTo(self.region_nodes[region])
+            else:
                 m.root.reparentTo(self.rootNode)        # "hang" the mesh under our root node
+            if m.collision != None:
+                m.collision.reparentTo(self.collisionRoot)
+                
+        if self.collider != None:
+            self.collider.finalize()
+            self.world.consoleOut('region collider: %i triangles' % self.collider.getNumTriangles())
+            
+        if self.pvs_culling == 1:
+            self.world.consoleOut('pvs culling: %i bsp regions, %i with meshes, %i meshes unassigned' % 
+                (len(self.bsp_regions), len(self.region_nodes), self.region_root.getNumChildren()))
 
         
     # ---------------------------------------------------------------------             
     # create the SPRITE objects: these can reference a single texture or
     # a list of them (for animated textures like water, lava etc.)
-    # we need to step through all entries of the 0x31 list fragment for the zone
+    # we need to step through all entries of a 0x31 list fragment, these have been
+    # resolved into the container's material table already (see WLDContainer.buildMaterials())
     # We store the SPRITEs using their index within the 0x31 fragments list as the key
     # because this is exactly how the meshes (0x36 fragments) reference them
     # The lists them selves are keyed by the 0x31 fragmemts id (=index in the diskfile)
-    def loadSpriteList(self, wld_container, f31):
+    def loadSpriteList(self, wld_container, list_id):
     
-        wld = wld_container.wld_file_obj
-        wld_container.sprite_list[f31.id] = {}
-        sprite_list = wld_container.sprite_list[f31.id]
+        wld_container.sprite_list[list_id] = {}
+        sprite_list = wld_container.sprite_list[list_id]
         
         idx = 0
-        for ref30 in f31.nameRefs:
+        for material in wld_container.materials[list_id]:
             sprite_error = 0
-            sprite = None
-            # print ref30
-            f30 = wld.getFragment(ref30)
-            # f30.dump()
-
-            material_name = wld.getName(f30.nameRef)
-            
-            # Note on TRANSPARENCY: as far as I can tell so far, bit 2 in the params1 field of f30
-            # is the "semi-transparent" indicator used for all types of water surfaces for the old
-            # zones (pre POP? Seems to not work like this in zones like POV for example anymore)
-            # lets go by this theory anyway for now
-            '''
-            if f30.params1 & 0x00000004:
-                print 'SEMI TRANSPARENT MATERIAL:'
-                f30.dump()
-            '''    
-            # print 'looking up 0x05 fragment with id_plus_1:', f30.frag05Ref
-            
-            # Note that there are frag05Refs inside some 0x30 fragments with value <=0 
-            # these named references seem to point directly to 0x03 texture fragments
-            # instead of the usual indirection chain  0x05->0x04->0x03
-            # in some instances these point nowhere meaningful at all though. Need to catch all these
-            frag = wld.getFragment(f30.frag05Ref)
-            if frag != None:
-                if frag.type == 0x03:    # this is a direct 0x03 ref (see note above)
-                    f03 = frag
-                    texfile_name = f03.names[0]                   
+            if material == None:
+                sprite_error = 1
+            else:
+                sprite = Sprite(material.name, idx, material.flags, self.tm)
+                sprite.setAnimDelay(material.anim_delay)
+                
+                if material.kind == 'null':
+                    # this will be a sprite with just the dummy nulltex textures
+                    # we need this so that transparent zonewalls in the very old classic zones work
+                    # newer zones have actually textured ("collide.dds") zone walls
+                    sprite.addTexture('nulltexture', self.nulltex)
+                    
+                for texfile_name in material.texnames:
                     tx = self.tm.getTexture(texfile_name)
                     if tx != None:
-                        # we dont have a sprite def (0x04) for these, so we use the material (0x30) name
-                        sprite = Sprite(material_name, idx, f30.params1, self.tm)
                         sprite.addTexture(texfile_name, tx) 
                     else:
                         sprite_error = 1
-                        print 'Error in Sprite:', material_name, 'Texture not found:', texfile_name                        
-                elif frag.type == 0x05: # this is the "normal" indirection chain 0x30->0x05->0x04->0x03
-                    f05 = frag
-                    # f05.dump()
-                    f04 = wld.getFragment(f05.frag04Ref)
-                    # f04.dump()
-
-                    name = wld.getName(f04.nameRef)
-                    sprite = Sprite(name, idx, f30.params1, self.tm)
-                    sprite.setAnimDelay(f04.params2)
-                    
-                    for f03ref in  f04.frag03Refs:
-                        f03 = wld.getFragment(f03ref)
-                        # f03.dump()
-                        # NOTE that this assumes the zone 0x03 fragments only ever reference one single texture
-                        texfile_name = f03.names[0]
-                        tx = self.tm.getTexture(texfile_name)
-                        if tx != None:
-                            sprite.addTexture(texfile_name, tx) 
-                        else:
-                            sprite_error = 1
-                            print 'Error in Sprite:', name, 'Texure not found:', texfile_name
-                else:
-                    # This is the "does point nowhere meaningful at all" case
-                    # infact the reference points back to the same fragment (circular)
-                    # This type of 0x30 fragment seems  to only have been used for zone boundary polygons
-                    # in the original EQ classic zones 
-                    # Note that we create a sprite with just a dummy texture in it for these
-                    
-                    # sprite_error = 1
-                    print 'Warning : Non standard material:%s. Texture ref in 0x30 frag is not type 0x5 or 0x3 but 0x%x' % (material_name, frag.type)
-                    # print 'F30 DUMP:'
-                    # f30.dump()
-                    # print 'Referenced Fragment DUMP:'
-                    # frag.dump()
-                    
-                    # this will be a sprite with just the dummy nulltex textures
-                    # we need this so that transparent zonewalls in the very old classic zones work
-                    # newer zones have actually textured ("collide.dds") zone walls
-                    sprite = Sprite(material_name, idx, f30.params1, self.tm)
-                    sprite.addTexture('nulltexture', self.nulltex)
-            else:
-                sprite_error = 1
-                print 'Error in Sprite: could not resolve frag05ref:%i in 0x30 fragment:%i' % (f30.frag05Ref, f30.id)
+                        print 'Error in Sprite:', material.name, 'Texture not found:', texfile_name
 
             if sprite_error != 1:   # only add error free sprites
                 # sprite.dump()
@@ -242,39 +365,17 @@ class Zone():
     # wld_container is a WldContainer object
     def preloadWldTextures(self, wld_container):
         self.world.consoleOut('preloading textures for container: '+ wld_container.name)
-        wld = wld_container.wld_file_obj  # the in memory wld file
-        
-        # loop over all 0x03 fragments and PRELOAD all referenced texture files from the s3d
-        f31 = None
-        f31_list = []
-        for f in wld.fragments.values():
-            if f.type == 0x03:
-                # f.dump()
-                
-                # NOTE
-                # in VERSION 2 WLD zones (ex. povalor, postorms) I've found texture names
-                # that have three parameters prepended like this for example: 1, 4, 0, POVSNOWDET01.DDS
-                # no idea yet as to what these mean but in order to be able to load the texture from 
-                # the s3d container we need to strip this stuff
-                for name in f.names:
-                    i = name.rfind(',')
-                    if i != -1:
-                        # See NOTE above
-                        print 'parametrized texture name found:%s wld version:0x%x' % (name, self.wldZone.version)
-                        name = name[i+1:].strip()
-            
-                    self.tm.loadTexture(name.lower(), wld_container)
-                    
-            # need to store the 0x31 texture lists        
-            if f.type == 0x31:
-                f31_list.append(f)
+        
+        # resolve all materials of the container in one go, everything below works off that table
+        wld_container.buildMaterials()
+        
+        # PRELOAD all texture files referenced by the materials from the s3d
+        for name in wld_container.getTextureNames():
+            self.tm.loadTexture(name, wld_container)
                 
         # not all wld files define sprites
-        if len(f31_list) == 0:
-            return
-        
-        for f31 in f31_list:
-            self.loadSpriteList(wld_container, f31)
+        for list_id in sorted(wld_container.materials.keys()):
+            self.loadSpriteList(wld_container, list_id)
             #print("Loaded sprites got this many: " + str(len(wld_container.animated_sprites)))
         
         
@@ -307,7 +408,8 @@ class Zone():
         # Not encountered this yet though.
             
         self.world.consoleOut('setting up animated textures for zone geometry')        
-        for child in self.rootNode.getChildren():
+        # with pvs culling the geom nodes sit below the region nodes
+        for child in self.rootNode.findAllMatches('**/+GeomNode'):
             # print child
             geom_node = child.node()
             for geom_number in range(0, geom_node.getNumGeoms()):
@@ -350,17 +452,41 @@ class Zone():
         
         
         
+    # open one of the zone's s3d archives
+    # the archives are opened in lazy mode: we only ever use the wld files and the textures
+    # they reference so there is no point in inflating all the other files up front
+    # All our lookups are by name, these get resolved through the directory crcs which saves us 
+    # inflating the file name listing as well
+    # Returns the loaded S3DFile object or None if the archive does not exist
+    def loadS3DFile(self, name):
+        # the catalog knows which archives exist, don't bother trying to open the others
+        catalog = self.world.catalog
+        if catalog != None and not catalog.hasArchive(name):
+            return None
+
+        # the pool hands out archives that are still loaded from earlier zones
+        # our archives get pinned so trimming the pool never closes them while we use them
+        pool = self.world.s3d_pool
+        pool.pin(self.basedir+name)
+        return pool.getArchive(self.basedir+name)
+        
     # load up everything related to this zone
     def load(self):
         
+        # the fragment decode stats cover the last zone load, see fragment_codecs.dumpStats()
+        fragment_codecs.resetStats()
+        
+        # the archives of the previous zone are not in use anymore
+        self.world.s3d_pool.unpinAll()
+        
         # ---- ZONE GEOMETRY ----
         
         # load main zone s3d
         s3dfile_name = self.name+'.s3d'
         self.world.consoleOut('zone loading zone s3dfile: ' + s3dfile_name)
         
-        s3d = S3DFile(self.basedir+self.name)
-        if s3d.load() != 0:
+        s3d = self.loadS3DFile(self.name)
+        if s3d == None:
             self.world.consoleOut( 'ERROR loading s3dfile:' + self.basedir+s3dfile_name)
             return -1
             
@@ -381,14 +507,26 @@ class Zone():
         self.zone_obj_wld_container = WLDContainer('zone_obj', self, wldZoneObj, s3d)
         self.wld_containers['zone_obj'] = self.zone_obj_wld_container
 
+        # static lights: the point lights are in lights.wld (same container), the region ambient 
+        # lights in the zone wld. zone_lights is the number of point lights each zone mesh gets
+        if self.world.zone_lights > 0:
+            wldLights = WLDFile('lights')
+            wldLights.load(s3d)
+            self.lights = ZoneLights(self.name, self.world.zone_lights, self.world.ambientLightNp, 
+                self.world.directionalLightNp)
+            self.lights.loadPointLights(wldLights)
+            self.lights.loadAmbientLights(wldZone)
+            self.world.consoleOut('zone lights: %i point lights, %i regions with ambient lights' % 
+                (len(self.lights.lights), len(self.lights.ambient_lights)))
+
         # ---- placeables definitions ------------------------------------
         
         s3dfile_name = self.name+'_obj.s3d'
         print '-------------------------------------------------------------------------------------'
         self.world.consoleOut('zone loading placeable objects s3dfile: ' + s3dfile_name)
         
-        s3d = S3DFile(self.basedir+self.name+'_obj')
-        if s3d.load() == 0:
+        s3d = self.loadS3DFile(self.name+'_obj')
+        if s3d != None:
             # s3d.dumpListing()
             wldObj1 = WLDFile(self.name+'_obj')
             wldObj1.setDumpList([0x14, 0x13, 0x12, 0x11, 0x10])
@@ -402,8 +540,8 @@ class Zone():
         print '-------------------------------------------------------------------------------------'
         self.world.consoleOut('zone loading placeable objects 2 s3dfile: ' + s3dfile_name)
         
-        s3d = S3DFile(self.basedir+self.name+'_2_obj')
-        if s3d.load() == 0:
+        s3d = self.loadS3DFile(self.name+'_2_obj')
+        if s3d != None:
             # s3d.dumpListing()
             wldObj2 = WLDFile(self.name+'_2_obj')
             # wldObj2.setDumpList([0x14, 0x15, 0x2D, 0x36])
@@ -417,8 +555,8 @@ class Zone():
         print '-------------------------------------------------------------------------------------'
         self.world.consoleOut('zone loading character s3dfile: ' + s3dfile_name)
         
-        s3d = S3DFile(self.basedir+self.name+'_chr')
-        if s3d.load() == 0:
+        s3d = self.loadS3DFile(self.name+'_chr')
+        if s3d != None:
             # s3d.dumpListing()
             wldChr = WLDFile(self.name+'_chr')
             # wldChr.setDumpList([0x14, 0x15, 0x2D, 0x36])
@@ -442,18 +580,33 @@ class Zone():
         self.world.consoleOut('flattening zone mesh geom tree')        
         
         # self.rootNode.ls()
-        self.rootNode.flattenStrong()    
-        self.rootNode.ls()
+        if self.pvs_culling == 1:
+            # flattening the whole tree would merge the regions, each region gets flattened on its own
+            # (the geoms can't be batched across regions but the hidden regions cost nothing)
+            for node in self.region_nodes.values():
+                node.flattenStrong()
+            self.region_root.flattenStrong()
+        else:
+            self.rootNode.flattenStrong()    
+            self.rootNode.ls()
 
         # texture->sprite remapping after the flatten above
         self.remapTextures()
+        
+        if self.lights != None:
+            self.lights.root.reparentTo(self.rootNode)
                     
         # COLLISION:
-        # The following makes the complete zone base geometry eligible for collisions
-        # this is of course extremely inefficient. TODO: at some point we need to use the
-        # bsp structures already provided in the wld file to optimize whats in our scene graph
-        # and also to build a more intelligent collision system
-        self.rootNode.setCollideMask(BitMask32.bit(0)) 
+        # The collision geometry holds all solid polygons of the zone base geometry: passable ones
+        # (foliage etc) are left out, invisible ones (zone walls) are in although they are not drawn
+        # the render geometry itself does not take part in collisions
+        # Zones with a bsp tree use the region collider instead (see getGroundHeight()), this is only
+        # the fallback for the panda collision traverser
+        if self.collider == None:
+            self.collisionRoot.flattenStrong()
+            self.collisionRoot.setCollideMask(BitMask32.bit(0)) 
+            self.collisionRoot.reparentTo(self.rootNode)
+            self.collisionRoot.hide()     # hidden nodes still collide
 
         # ---- load MODELS and spawn placeables -----------------------
         
@@ -461,9 +614,16 @@ class Zone():
         # for every unique entry
         self.world.consoleOut( 'loading placeables models')
         self.mm.loadPlaceables(wldZoneObj)
+        self.world.consoleOut('%i animated meshes' % self.morph_engine.getNumMeshes())
         # self.rootNode.ls()
         
+        # per fragment type decode counts and times for this zone (debug output)
+        if self.world.fragment_stats == 1:
+            fragment_codecs.dumpStats()
             
+        # everything we needed is inflated by now, get the archive pool back within its budget
+        self.world.s3d_pool.trim()
+        
         print 'zone load complete'
         self.load_complete = 1
         
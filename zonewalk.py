@@ -57,6 +57,9 @@ from pandac.PandaModules import WindowProperties
 
 from zone import Zone
 from config import Configurator
+from file.s3dcache import S3DCache
+from file.catalog import S3DCatalog
+from file.s3dpool import S3DPool
 from gui.filedialog import FileDialog
 from net.client import UDPClientStream
 
@@ -179,11 +182,66 @@ class World(DirectObject):
         if resaveRes:
             self.saveDefaultRes()
 
+        # number of worker threads used to inflate s3d archives, 0 inflates on the main thread
+        if 's3d_threads' in cfg:
+            self.s3d_threads = int(cfg['s3d_threads'])
+        else:
+            self.s3d_threads = 0
+
+        # on disk cache for inflated s3d archive contents, off unless s3d_cache_dir is set
+        # s3d_cache_mb is the size limit of all cache files together
+        if 's3d_cache_dir' in cfg:
+            s3d_cache_dir = cfg['s3d_cache_dir']
+        else:
+            s3d_cache_dir = ''
+
+        if 's3d_cache_mb' in cfg:
+            s3d_cache_mb = int(cfg['s3d_cache_mb'])
+        else:
+            s3d_cache_mb = 512
+
+        self.s3d_cache = None
+        if s3d_cache_dir != '':
+            self.s3d_cache = S3DCache(s3d_cache_dir, s3d_cache_mb*1024*1024)
+
+        # loaded archives are kept in a pool across zone loads, s3d_pool_mb is its memory budget
+        if 's3d_pool_mb' in cfg:
+            s3d_pool_mb = int(cfg['s3d_pool_mb'])
+        else:
+            s3d_pool_mb = 256
+        self.s3d_pool = S3DPool(s3d_pool_mb*1024*1024, self.s3d_threads, self.s3d_cache)
+
+        # catalog of the s3d archives under basepath, built/updated in load()
+        if 'catalog_file' in cfg:
+            self.catalog_file = cfg['catalog_file']
+        else:
+            self.catalog_file = 'zonewalk.catalog'
+        self.catalog = None
+
+        # only draw the zone regions potentially visible from the camera's bsp region
+        if 'pvs_culling' in cfg:
+            self.pvs_culling = int(cfg['pvs_culling'])
+        else:
+            self.pvs_culling = 1
+
+        # fragment_stats = 1 prints the wld fragment decode counts and times after each zone load
+        if 'fragment_stats' in cfg:
+            self.fragment_stats = int(cfg['fragment_stats'])
+        else:
+            self.fragment_stats = 0
+
+        # number of static zone point lights (from lights.wld) per zone mesh, 0 turns zone lights off
+        if 'zone_lights' in cfg:
+            self.zone_lights = int(cfg['zone_lights'])
+        else:
+            self.zone_lights = 4
+
         self.xres_half = self.xres / 2
         self.yres_half = self.yres / 2
         self.mouse_accum = MouseAccume( lambda: (self.xres_half,self.yres_half))
 
         self.eyeHeight = 7.0
+        self.maxGroundDrop = 2000.0     # how far below the camera walk mode looks for ground
         self.rSpeed = 80
         self.flyMode = 1
 
@@ -207,6 +265,7 @@ class World(DirectObject):
         self.inst1 = addInstructions(-0.95, "Camera control with WSAD/mouselook. Press K for hotkey list, ESC to exit.")
         self.inst2 = addInstructions(0.9,  "Loc:")
         self.inst3 = addInstructions(0.85, "Hdg:")
+        self.inst4 = addInstructions(0.8, "Region:")
         self.error_inst = addInstructions(0, '')
         self.kh = []
         
@@ -221,14 +280,16 @@ class World(DirectObject):
         ambient_level = .6
         ambientLight = AmbientLight("ambientLight")
         ambientLight.setColor(Vec4(ambient_level, ambient_level, ambient_level, 1.0))
-        render.setLight(render.attachNewNode(ambientLight))
+        self.ambientLightNp = render.attachNewNode(ambientLight)
+        render.setLight(self.ambientLightNp)
 
         direct_level = 0.8
         directionalLight = DirectionalLight("directionalLight")
         directionalLight.setDirection(Vec3(0.0, 0.0, -1.0))
         directionalLight.setColor(Vec4(direct_level, direct_level, direct_level, 1))
         directionalLight.setSpecularColor(Vec4(direct_level, direct_level, direct_level, 1))
-        render.setLight(render.attachNewNode(directionalLight))
+        self.directionalLightNp = render.attachNewNode(directionalLight)
+        render.setLight(self.directionalLightNp)
         
         # create a point light that will follow our view point (the camera for now)
         # attenuation is set so that this point light has a torch like effect
@@ -532,7 +593,16 @@ class World(DirectObject):
         # we simply check a ray from slightly below the "eye point" straight down
         # for geometry collisions and if there are any we detect the point of collision
         # and adjust the camera's Z accordingly
-        if self.flyMode == 0:   
+        if self.flyMode == 0 and self.zone != None and self.zone.collider != None:
+            # zones with a bsp tree: only the regions below and between the positions get tested
+            ground = self.zone.getGroundHeight(self.campos.getX(), self.campos.getY(), self.campos.getZ(), 
+                self.maxGroundDrop)
+            if ground != None and not self.zone.isMoveBlocked(lastPos, self.campos):
+                self.campos.setZ(ground+self.eyeHeight)
+            else:
+                self.campos = lastPos
+            base.camera.setPos(self.campos)
+        elif self.flyMode == 0:   
             # move the camera to where it would be if it made the move 
             # the colliderNode moves with it
             # base.camera.setPos(self.campos)
@@ -562,6 +632,8 @@ class World(DirectObject):
         hpr = base.camera.getHpr()
         self.inst2.setText('Loc: %.2f, %.2f, %.2f' % (pos.getX(), pos.getY(), pos.getZ()))
         self.inst3.setText('Hdg: %.2f, %.2f, %.2f' % (hpr.getX(), hpr.getY(), hpr.getZ()))
+        if self.zone != None and self.zone.load_complete == 1:
+            self.inst4.setText('Region: '+self.zone.getRegionText(pos.getX(), pos.getY(), pos.getZ()))
         return task.cont
 
         
@@ -611,6 +683,7 @@ class World(DirectObject):
             
         self.zone = Zone(self, name, path)
         error = self.zone.load()
+        self.consoleOut(self.s3d_pool.statsText())
         if error == 0:
             self.consoleOff()
             self.setFlymodeText()
@@ -631,7 +704,16 @@ class World(DirectObject):
             
         zone_name = cfg['default_zone']
         basepath = cfg['basepath']
+        self.updateCatalog(basepath)
         self.loadZone(zone_name, basepath)
+
+    # bring the archive catalog up to date, only new or changed archives get scanned
+    def updateCatalog(self, basepath):
+        self.consoleOut('updating archive catalog')
+        self.catalog = S3DCatalog(basepath, self.catalog_file)
+        n_scanned = self.catalog.update()
+        self.consoleOut('archive catalog: %d archives, %d zones, %d rescanned' % (len(self.catalog.archives),
+            len(self.catalog.zones), n_scanned))
     
 
     # config save user interfacce
@@ -656,9 +738,17 @@ class World(DirectObject):
     # this gets called from the form when the user has entered a something
     # (hopefully a correct zone short name)
     def reloadZoneDialogCB(self, name):
+        if self.catalog != None and not self.catalog.hasZone(name):
+            # the archives may have been added or changed since the last update, only those get rescanned
+            self.catalog.update()
+            if not self.catalog.hasZone(name):
+                self.frmDialog.setStatus('Unknown zone: ' + name)
+                return 0
+
         self.frmDialog.end()
         self.zone_reload_name = name
         self.toggleControls(1)
+        return 1
 
     # this is called when the user presses "l"
     # it disables normal controls and fires up our query form dialog